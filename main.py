@@ -2,12 +2,14 @@
 """ Main interface """
 
 import sys
-from random import randint
+from random import Random
 
 from src.twitter_bot import TwitterBot
 from src.wiki_scraper import WikiScraper
 from src.sentence import Sentence
 from src.chain import Chain
+from src.parallel import generate_parallel
+from src.server import GenerationServer
 
 HELP_STRING = ("Tweets sentences generated by markov chains,\n"
                "using minervawikin.nu as learning material.\n\n"
@@ -16,9 +18,19 @@ HELP_STRING = ("Tweets sentences generated by markov chains,\n"
                "  help                          Print this helpful information.\n"
                "  run                           Run the bot.\n"
                "  print  [count] [first_word]   Print generated sentences *count* times (default 1).\n"
-               "  update [recent|all|users]     Update all or recent corpus pages (default recent).\n\n"
+               "  update [recent|all|users]     Update all or recent corpus pages (default recent).\n"
+               "  serve  [port]                 Serve generated sentences on localhost (default port 8080),\n"
+               "                                GET /generate?count=N&min=N&max=N&first_word=W&seed=N\n\n"
                "Flags:\n"
                "  --debug:               Print debug information during execution of given command.\n"
+               "  --mmap:                Memory map the saved model instead of loading it (print).\n"
+               "  --workers=N:           Build the model and generate sentences in N worker processes.\n"
+               "  --seed=N:              Seed the random generator, for repeatable output (print),\n"
+               "                         the same for any number of --workers.\n"
+               "  --min-count=N:         Prune successors counted fewer than N times from new models.\n"
+               "  --max-successors=N:    Prune all but the N most counted successors from new models.\n"
+               "  --prune-deterministic: Prune keys that only repeat the successor of a shorter key.\n"
+               "  --corpus-db:           Keep the corpus in the single file corpus.db instead of a folder.\n"
               )
 
 USAGE = "Usage: sapp_bot <command> [flag]... [argument]..."
@@ -48,17 +60,41 @@ def main():
 
     # Recognized flags with default values
     program_flags = {
-        "--debug": False
+        "--debug": False,
+        "--mmap": False,
+        "--workers": 1,
+        "--seed": None,
+        "--min-count": None,
+        "--max-successors": None,
+        "--prune-deterministic": False,
+        "--corpus-db": False
     }
 
-    # Set program flags from input flags
+    # Set program flags from input flags, "--flag=N" for flags with numeric values.
     for flag in input_flags:
-        if flag in program_flags:
+        flag, _, value = flag.partition('=')
+        if flag not in program_flags:
+            print('Unrecognized flag \'', flag, '\'.')
+            sys.exit(1)
+        elif isinstance(program_flags[flag], bool):
             program_flags[flag] = True
+        elif value.isdigit():
+            program_flags[flag] = int(value)
         else:
-            print('Unrecognized flag \'', flag, '\'.')
+            print('Flag \'', flag, '\' needs an integer value.')
             sys.exit(1)
 
+    # Pruning of multi-word keys in new models, see model.prune_model.
+    pruning = dict()
+    if program_flags['--min-count'] is not None:
+        pruning['min_count'] = program_flags['--min-count']
+    if program_flags['--max-successors'] is not None:
+        pruning['max_successors'] = program_flags['--max-successors']
+    if program_flags['--prune-deterministic']:
+        pruning['deterministic'] = True
+
+    corpus_path = 'corpus.db' if program_flags['--corpus-db'] else 'corpus'
+
 
     if cmd == 'help':
         print(HELP_STRING)
@@ -79,16 +115,23 @@ def main():
             first_word = args[1]
 
         # TODO: seond option = first_word
-        chain = Chain('corpus', program_flags['--debug'])
-        chain.build_model()
-
+        chain = Chain(corpus_path, program_flags['--debug'], program_flags['--mmap'],
+                      Random(program_flags['--seed']), pruning)
+        chain.build_model(program_flags['--workers'])
+
+        # Seeded sentences are generated in chunks of their own random streams, like in workers.
+        if program_flags['--workers'] > 1 or program_flags['--seed'] is not None:
+            for sentence in generate_parallel(chain, int(count), (230, 270), first_word,
+                                              program_flags['--workers'], program_flags['--seed']):
+                print(sentence + "\n\n")
+            sys.exit(0)
+
+        sentences = Sentence.generate_batch(chain, int(count), (230, 270), first_word)
         for _ in range(int(count)):
             try:
-                max_chars = randint(230, 270)
+                sentence = next(sentences)
                 if program_flags['--debug']:
-                    print("Generating tweet of", max_chars, "characters...")
-                sentence = Sentence(chain, max_chars)
-                sentence.generate(first_word)
+                    print("Generated tweet of max", sentence.max_characters, "characters:")
                 print(str(sentence), end='')
                 if program_flags['--debug']:
                     print("(" + str(len(str(sentence))) + ")\n")
@@ -97,21 +140,52 @@ def main():
                 print("\n")
             except Exception as e:
                 print("Error in main.print:", str(e))
+                sentences = Sentence.generate_batch(chain, int(count), (230, 270), first_word)
 
     elif cmd == 'update':
-        ws = WikiScraper()
+        ws = WikiScraper(corpus_path=corpus_path)
+        changes = None
 
         if len(args) == 1:
             if args[0] == 'all':
-                ws.update_all_pages()
+                changes = ws.update_all_pages()
             elif args[0] == 'recent':
-                ws.update_recent_changes()
+                changes = ws.update_recent_changes()
             elif args[0] == 'users':
                 ws.update_users()
             else:
                 print("Unknown print argument \"" + args[0], "\"")
         else:
-            ws.update_recent_changes()
+            changes = ws.update_recent_changes()
+
+        # Apply the changed pages to the saved model right away,
+        # or build a new one if too much changed.
+        if changes is not None:
+            chain = Chain(corpus_path, program_flags['--debug'], pruning=pruning)
+            if not chain.update_model(changes, load=False):
+                chain.build_model(program_flags['--workers'])
+
+    elif cmd == 'serve':
+        port = 8080
+        if len(args) >= 1:
+            if args[0].isdigit():
+                port = int(args[0])
+            else:
+                print("Serve port must be integer!")
+                print(USAGE)
+                sys.exit(1)
+
+        chain = Chain(corpus_path, program_flags['--debug'], program_flags['--mmap'],
+                      Random(program_flags['--seed']), pruning)
+        chain.build_model(program_flags['--workers'])
+
+        server = GenerationServer(('127.0.0.1', port), chain)
+        print("Serving on http://127.0.0.1:" + str(port) + "/generate")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Manually shut down. Bye!")
+        server.server_close()
 
     elif cmd == 'run':
         bot = TwitterBot("config/bot_config.json")
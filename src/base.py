@@ -3,11 +3,58 @@
 General helper functions
 """
 
+import os
+import json
 from datetime import datetime
 
+_line_cache = dict()    # path: (modification time, lines)
+_set_cache = dict()     # path: (lines, set of lines)
+
 
 def prompt_print(text):
     """Wrapper function to print with prepended current time"""
     now = datetime.now()
     prompt = '[{}/{}/{} - {:02}:{:02}:{:02}] '.format(now.day, now.month, now.year, now.hour, now.minute, now.second)
     print(prompt + text)
+
+
+def read_lines(path):
+    """
+    Return tuple of the lines in a text file.
+    Lines are cached until the file is modified, so resource files
+    can be looked up for every generated sentence without re-reading them.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _line_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, encoding='utf8') as file:
+            cached = (mtime, tuple(file.read().split("\n")))
+        _line_cache[path] = cached
+
+    return cached[1]
+
+
+def write_json(path, data):
+    """
+    Write data to a JSON file, creating its directory if needed.
+    The old file is replaced only once the new one is fully written,
+    so a crash never leaves a broken file behind.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path + ".tmp", "w", encoding='utf8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def read_set(path):
+    """Return frozenset of the lines in a text file, for lookups. Cached like read_lines."""
+    lines = read_lines(path)
+    cached = _set_cache.get(path)
+    if cached is None or cached[0] is not lines:
+        cached = (lines, frozenset(lines))
+        _set_cache[path] = cached
+
+    return cached[1]
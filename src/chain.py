@@ -3,168 +3,403 @@
 
 import os
 import re
-from random import randint
+import sys
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from random import Random
 import numpy as np
 
+import src.model as markov_model
+import src.base as base
+from src.corpus_store import CorpusStore, is_corpus_store
+
+# Words made of only these characters are skipped.
+PUNCTUATION = "~-,./?!\\;:\"()"
+# Removed from words, slashes are replaced by spaces.
+WORD_TABLE = str.maketrans({**dict.fromkeys("()\"“”:;'[]"), '/': ' '})
+DASHED_WORD = re.compile(r"[\-]([\w\d]+?)[\-]")
+
 
 class Chain():
-    """Markov Chain Generator"""
-    def __init__(self, corpus_path, debug=False):
+    """
+    Markov Chain Generator
+    Every word is interned to an integer id. Keys are tuples of word ids
+    and values are word ids, words are only looked up for output.
+    The model maps each key to a (successors, cumulative counts) pair,
+    so a weighted step is a single bisect.
+    """
+    def __init__(self, corpus_path, debug=False, mmap=False, rng=None, pruning=None):
         self.corpus_path = corpus_path
+        self.corpus_store = None    # CorpusStore, if corpus_path is one.
+        if corpus_path is not None and is_corpus_store(corpus_path):
+            self.corpus_store = CorpusStore(corpus_path)
+        self.rng = rng if rng is not None else Random()  # All randomness of generation.
         self.complexity = 10
         self.debug = debug
-        self.generators = list()
-        self.corpus = list()    # Splitted words
         self.model = None
-        self.values = None
+        self.model_path = "models/markov"
+        self.documents_path = "models/documents"
+        self.mmap = mmap    # Map the saved model read-only instead of loading it into a dict.
+        self.fingerprint = None
+        self.pruning = pruning  # Keyword arguments of model.prune_model, for new models.
+        self.vocabulary = list()    # Word of every word id.
+        self.word_ids = dict()
+        self.word_lengths = list()
+        self.digit_ids = set()      # Words that are numbers.
+        self.punctuated_ids = set() # Words containing ".", "!" or "?".
+        self.ending_ids = set()     # Words ending with ".", "!" or "?".
+        self.start_keys = None      # Key pool for first words, see index_keys.
+        self.restart_keys = None    # Key pool for words after punctuation.
+        self.max_redraws = 5        # Redraws of a too repeated word, before backtracking.
+        self.max_backtracks = 20    # Words taken back per chain, before repetition is allowed.
 
         # TODO: Make newline not continue as sentence? Names get combined together.
 
-    def build_model(self):
-        """Build a new Model from Corpus"""
+    def build_model(self, workers=None):
+        """
+        Load the saved Model, update it if the corpus changed, or build a new one from Corpus.
+        A new Model is counted in workers processes, if more than one.
+        """
+        documents = markov_model.corpus_documents(self.corpus_path)
+        self.fingerprint = markov_model.corpus_fingerprint(documents, self.complexity, self.pruning)
+        if self.load_model(self.model_path):
+            return
+
+        if self.update_model():
+            return
+
+        if self.debug:
+            print("Saved model missing or stale, building from corpus...")
+
+        self.set_vocabulary(list())
+
+        store = markov_model.DocumentStore(self.documents_path)
+        store.reset()
+        self.model = self.instantiate_model(documents, store, workers=workers)
+        store.save(self.fingerprint)
+
+        if self.mmap:
+            self.model = markov_model.MappedModel(self.model_path)
+
+        self.set_vocabulary(self.vocabulary)
+        self.index_keys()
+
+    def update_model(self, changes=None, load=True):
+        """
+        Apply corpus changes to the saved Model instead of rebuilding it.
+        changes is a change set from WikiScraper, a dict of 'added', 'replaced'
+        and 'removed' document names. Documents changed in any other way are
+        found by comparing the corpus with the documents the Model was built from.
+        An unchanged Model is left as saved. The Model is only loaded
+        into the chain if load is set.
+        Return False if there is no saved Model to update, if so much
+        changed that building a new Model is cheaper, or if the Model is
+        pruned, as pruned counts can't be subtracted exactly.
+        """
+        if self.pruning:
+            return False
+
+        store = markov_model.DocumentStore(self.documents_path)
+        if not store.load() or store.fingerprint != markov_model.read_fingerprint(self.model_path):
+            return False
+
+        # Model was built with another complexity.
+        if markov_model.corpus_fingerprint(store.signatures(), self.complexity, self.pruning) != store.fingerprint:
+            return False
+
+        documents = markov_model.corpus_documents(self.corpus_path)
+        self.fingerprint = markov_model.corpus_fingerprint(documents, self.complexity, self.pruning)
+
+        changed = set()
+        for names in markov_model.diff_documents(store.signatures(), documents).values():
+            changed.update(names)
+        if changes is not None:
+            for names in changes.values():
+                changed.update(names)
+
+        if not changed:
+            return not load or self.load_model(self.model_path)
+
+        if len(changed) > len(documents) / 2:
+            return False
+
+        if self.debug:
+            print("Updating model with", len(changed), "changed documents...")
+
+        # New words are appended, so ids in the saved model and documents stay valid.
+        self.set_vocabulary(markov_model.load_vocabulary(self.model_path))
+
+        # Count what the old versions contributed and what the new ones do,
+        # and merge the difference into the saved model.
+        added = dict()
+        removed = dict()
+        for name in changed:
+            if name in store.index:
+                for paragraph in store.read(name):
+                    self.expand_model(removed, paragraph)
+                store.remove(name)
+
+            if name in documents:
+                paragraphs = list()
+                for paragraph in self.read_document(name):
+                    self.expand_model(added, paragraph)
+                    paragraphs.append(paragraph)
+                store.write(name, documents[name], paragraphs)
+
+        markov_model.update_saved_model(self.model_path, added, removed, self.vocabulary, self.fingerprint)
+        store.save(self.fingerprint)
+        if store.compact() and self.debug:
+            print("Compacted stored documents.")
+
+        return not load or self.load_model(self.model_path)
+
+    def read_document(self, name):
+        """Yield filtered word id lists, one per paragraph in corpus document, reading a line at a time."""
+        if self.corpus_store is not None:
+            for paragraph in (self.corpus_store.read(name) or '').split('\n'):
+                yield self.intern(self.filter_words(paragraph))
+            return
+
         if os.path.isdir(self.corpus_path):
-            for (dirpath, _, filenames) in os.walk(self.corpus_path):
-                for filename in filenames:
-                    with open(os.path.join(dirpath, filename)) as f:
-                        txt = f.read()
-
-                    # For each paragraph in the loaded file, filter the words
-                    # and add as lists in corpus.
-                    for paragraph in txt.split('\n'):
-                        self.corpus.append(self.filter_words(paragraph))
+            path = os.path.join(self.corpus_path, name)
         else:
-            with open(self.corpus_path, encoding='utf8') as f:
-                txt = f.read()
-                for paragraph in txt.split('\n'):
-                    self.corpus.append(self.filter_words(paragraph))
+            path = self.corpus_path
 
+        with open(path, encoding='utf8') as f:
+            for paragraph in f:
+                yield self.intern(self.filter_words(paragraph))
 
-        # Yield generator objects from corpus.
-        for i in range(self.complexity):
-            self.generators.append(self.create_model_generator(i + 2))
+    def read_documents(self, names):
+        """
+        Yield name and paragraphs of every named corpus document, as read_document does.
+        A CorpusStore is read sequentially in one query, in the order of its documents.
+        """
+        if self.corpus_store is None:
+            for name in names:
+                yield name, self.read_document(name)
+            return
 
-        self.model = self.instantiate_model()
+        for name, content in self.corpus_store.contents():
+            if name in names:
+                yield name, (self.intern(self.filter_words(paragraph)) for paragraph in content.split('\n'))
 
     def filter_words(self, text):
-        """Return list of accepted and filtered words from a string."""
-        paragraph_words = list()
-        punct_only_word = "^[\~\-\,\.\/?\!\\\/\;\:\"\(\)]+$"
+        """
+        Return list of accepted and filtered words from a string.
+        The whole paragraph is lowered, cleaned and split at once, with
+        the accepted words joined by newlines, which words never contain.
+        """
+        # Skip words of only punctuation.
+        words = [word for word in text.split() if word.strip(PUNCTUATION)]
+        if not words:
+            return words
+
+        text = '\n'.join(words).lower().translate(WORD_TABLE)
+        text = DASHED_WORD.sub(r'\0', text)
+
+        return text.split('\n')
+
+    def intern(self, words):
+        """Return list of word ids for words, adding unseen words to the vocabulary."""
+        word_ids = self.word_ids
+        for word in words:
+            if word not in word_ids:
+                word_ids[word] = len(self.vocabulary)
+                self.vocabulary.append(word)
+
+        return [word_ids[word] for word in words]
+
+    def set_vocabulary(self, vocabulary):
+        """Use vocabulary as the words of all word ids, and index their properties."""
+        self.vocabulary = vocabulary
+        self.word_ids = {word: i for i, word in enumerate(vocabulary)}
+        self.word_lengths = [len(word) for word in vocabulary]
+        self.digit_ids = set(i for i, word in enumerate(vocabulary) if word.isdigit())
+        self.punctuated_ids = set(i for i, word in enumerate(vocabulary)
+                                  if any(punct in word for punct in [".", "!", "?"]))
+        self.ending_ids = set(i for i, word in enumerate(vocabulary)
+                              if len(word) > 0 and word[-1] in [".", "!", "?"])
+
+    def words(self, values):
+        """Return the words of a list of word ids."""
+        return [self.vocabulary[value] for value in values]
 
-        for word in text.split():
-            if re.match(punct_only_word, word) is None:
-                word = word.lower()
-                # word = re.sub(r"[\-\,\.\?\!\(\)\"\“\”\:\'\[\]]", '', word)
-                word = re.sub(r"[\(\)\"\“\”\:\;\'\[\]]", '', word)
-                word = re.sub(r"[\-]([\w\d]+?)[\-]", r'\0', word)
-                word = re.sub(r"[\/]", ' ', word)
+    def load_model(self, file):
+        """
+        Load a Model from File.
+        Return False if the file is missing or was built from another corpus.
+        """
+        if self.mmap:
+            saved_fingerprint = markov_model.read_fingerprint(file)
+            if saved_fingerprint is None:
+                return False
+            if self.fingerprint is not None and saved_fingerprint != self.fingerprint:
+                return False
+            model = markov_model.MappedModel(file)
+            vocabulary = model.vocabulary
+        else:
+            model = markov_model.load_model(file, self.fingerprint)
+            if model is None:
+                return False
+            vocabulary = markov_model.load_vocabulary(file)
 
-                paragraph_words.append(word)
+        if self.debug:
+            print("Loaded model from", file)
 
-        return paragraph_words
+        self.model = model
+        self.set_vocabulary(vocabulary)
+        self.index_keys()
+        return True
 
+    def index_keys(self):
+        """
+        Index the keys random restarts are drawn from.
+        start_keys prefers keys whose first word has more than 3 successors,
+        restart_keys prefers keys that have more than 2 successors themselves.
+        """
+        first_words, lengths, successor_counts = self.model.key_table()
 
-    def load_model(self, file):
-        """Load a Model from File"""
-        # 1. load model from file
-        # 2. instantiate_model()
-        pass
-
-    def pick_multi_continue(self, first_word):
-        """Pick a random word that is part of multikey, beginning with first_word."""
-        multi_key_search = '^' + first_word + '\s(.+?(?:\s.+?)*)'
-        multi_keys = list()
-        word = None
+        # Successors of every word, as a single key.
+        word_successors = np.zeros(len(self.vocabulary), dtype=np.int64)
+        single_keys = lengths == 1
+        word_successors[first_words[single_keys]] = successor_counts[single_keys]
 
-        for key in list(self.model.keys()):
-            if re.match(multi_key_search, key):
-                multi_keys.append(key)
+        self.start_keys = self.key_pool(word_successors[first_words] > 3)
+        self.restart_keys = self.key_pool(successor_counts > 2)
 
-        if len(multi_keys) > 0:
-            multi_key = np.random.choice(multi_keys, 1)[0]
-            word = ''.join(multi_key.split(' ')[-1])
+    @staticmethod
+    def key_pool(preferred, keep_chance=0.1):
+        """
+        Return (preferred key indices, other key indices, chance to pick preferred).
+        Picking from it is the same as picking random keys and, with
+        1 - keep_chance, picking again while the key isn't preferred.
+        """
+        preferred_keys = np.flatnonzero(preferred).astype(np.int32)
+        other_keys = np.flatnonzero(~preferred).astype(np.int32)
+        weight = len(preferred_keys) + keep_chance * len(other_keys)
+        chance = len(preferred_keys) / weight if weight > 0 else 0
+        return preferred_keys, other_keys, chance
+
+    def random_key(self, pool=None):
+        """Pick a random key from the model, or from a pool made by key_pool."""
+        if pool is None:
+            return self.model.key(self.rng.randrange(len(self.model)))
+
+        preferred_keys, other_keys, chance = pool
+        keys = preferred_keys if self.rng.random() < chance or len(other_keys) == 0 else other_keys
+        return self.model.key(int(keys[self.rng.randrange(len(keys))]))
+
+    def pick_multi_continue(self, first_words):
+        """Pick a random word that is part of multikey, beginning with the first_words tuple."""
+        word = None
+
+        # Keys beginning with first_words are next to each other in the model's sorted keys.
+        start, end = self.model.prefix_range(first_words)
+        if start < end:
+            multi_key = self.model.key(self.rng.randrange(start, end))
+            word = multi_key[-1]
 
         return word
 
-    def generate(self, max_chars, fw=None):
-        """Generate Markov Chain based on Model"""
+    def generate_many(self, count, max_chars, fw=None):
+        """
+        Yield count independently generated chains, as lists of word ids.
+        max_chars is a number, or a (min, max) range to pick every chain's length from.
+        """
+        for _ in range(count):
+            if isinstance(max_chars, tuple):
+                yield self.generate(self.rng.randint(*max_chars), fw)
+            else:
+                yield self.generate(max_chars, fw)
+
+    def generate(self, max_chars, fw=None, max_occurrence=None, per_sentence=False):
+        """
+        Generate Markov Chain based on Model, return it as a list of word ids.
+        With max_occurrence, no word is picked more times than that, in the
+        whole chain or in every sentence of it. Steps that would be are drawn
+        again, and after max_redraws the last word is taken back instead,
+        at most max_backtracks times before the limit is given up on.
+        """
         # Pick a random capitalized first word.
-        word = np.random.choice(list(self.model.keys()), 1)[0]
-        first_word = word.split(' ')[0]
+        word = self.random_key()
+        first_word = word[0]
 
         if fw is None:
             first = ""
         else:
             first = fw
 
-        if first != "" and first.lower() in self.model.keys():
-            first_word = first
+        if first != "" and (self.word_ids.get(first.lower()),) in self.model:
+            first_word = self.word_ids[first.lower()]
 
-        elif os.path.isfile("config/saved_users.txt") and randint(1, 100) > 50:
-            users = list()
+        elif os.path.isfile("config/saved_users.txt") and self.rng.randint(1, 100) > 50:
+            users = base.read_lines('config/saved_users.txt')
 
-            with open('config/saved_users.txt', 'r') as file:
-                users = file.read().split("\n")
+            # Only users that can start a chain. The file ends with an empty line,
+            # and the empty word can't be capitalized.
+            users = [self.word_ids[user.lower()] for user in users
+                     if user and (self.word_ids.get(user.lower()),) in self.model]
 
             if len(users) > 0:
-                while first == "" or first.lower() not in self.model.keys():
-                    first = np.random.choice(users, 1)[0]
-
-                first_word = first
+                first_word = users[self.rng.randrange(len(users))]
 
         else:
             # 90% chance to pick another random word if chosen words key only has 3 or less values.
-            while len(self.model[first_word].values()) <= 3 and randint(1, 100) > 10:
-                try:
-                    word = np.random.choice(list(self.model.keys()), 1)[0]
-                    first_word = word.split(' ')[0]
-                except Exception as e:
-                    print("Error in chain.generate:", str(e))
-                    pass # TODO: Handle this.
+            first_word = self.random_key(self.start_keys)[0]
 
         if self.debug:
-            print("First word:", first_word)
+            print("First word:", self.vocabulary[first_word])
 
-        self.values = [first_word]
+        values = [first_word]
         second_word = None
 
         try:
-            second_word = self.pick_multi_continue(first_word)
-            self.values.append(second_word)
-            if self.debug:
-                print("Second word:", second_word)
+            second_word = self.pick_multi_continue((first_word,))
+            if second_word is not None:
+                values.append(second_word)
+                if self.debug:
+                    print("Second word:", self.vocabulary[second_word])
         except BaseException as exception:
             print(str(exception))
 
         if second_word is not None:
             try:
-                third_word = self.pick_multi_continue(first_word + " " + second_word)
+                third_word = self.pick_multi_continue((first_word, second_word))
                 if third_word is not None:
-                    self.values.append(third_word)
+                    values.append(third_word)
                     if self.debug:
-                        print("Third word:", third_word)
+                        print("Third word:", self.vocabulary[third_word])
             except BaseException as exception:
                 print(str(exception))
 
+        # Characters of the words so far, including separating spaces.
+        chars_used = sum(self.word_lengths[value] for value in values) + len(values) - 1
+
+        # Occurrences of every word, in the chain or the current sentence.
+        occurrences = self.count_occurrences(values, per_sentence)
+        redraws = 0
+        backtracks = 0
 
         # While there are characters left, keep chosing new words.
         character_capped = False
         while not character_capped:
-            value = self.walk()
+            value = (self.walk(values),)
 
             # Pick a random word if it is after punctuation.
-            if any(punct in self.values[-1] for punct in [".", "!", "?"]):
-                while len(self.model[value].values()) <= 2 and randint(1, 100) > 10:
-                    try:
-                        value = np.random.choice(list(self.model.keys()), 1)[0]
-                        first_word = value.split(' ')[0]
-                    except BaseException as exception:
-                        print("Error in chain.generate loop:", str(exception))
-                        # TODO: Handle this better
+            # 90% chance to pick a random key instead if the word has 2 or less values.
+            if values[-1] in self.punctuated_ids:
+                successors = self.model.get(value)
+                if (successors is None or len(successors[0]) <= 2) and self.rng.randint(1, 100) > 10:
+                    value = self.random_key(self.restart_keys)
 
             # After punctuation and first word after, try to pick multi_key word.
-            if len(self.values) > 2:
-                if any(punct in self.values[-2][-1] for punct in [".", "!", "?"]):
-                    value = self.pick_multi_continue(self.values[-1])
+            if len(values) > 2:
+                if values[-2] in self.ending_ids:
+                    multi_value = self.pick_multi_continue((values[-1],))
+                    if multi_value is not None:
+                        value = (multi_value,)
 
             # TODO: fix this mess....
             # # 40% chance to pick another random word if chosen words key only has one value.
@@ -181,92 +416,175 @@ class Chain():
             #     pass
 
 
-
-            chars = len(' '.join(self.values) + " " + value)
+            chars = chars_used + 1 + self.word_lengths[value[-1]]
             # print(chars)
 
             if chars > max_chars:
                 character_capped = True
+            elif max_occurrence is not None and occurrences[value[-1]] >= max_occurrence \
+                    and backtracks < self.max_backtracks:
+                # Draw again, or take back the word that keeps leading here.
+                redraws += 1
+                if redraws > self.max_redraws and len(values) > 1:
+                    chars_used -= self.word_lengths[values.pop()] + 1
+                    occurrences = self.count_occurrences(values, per_sentence)
+                    redraws = 0
+                    backtracks += 1
+                continue
             else:
-                self.values.append(value.split()[-1])
+                values.append(value[-1])
+                chars_used = chars
+                redraws = 0
+                if per_sentence and value[-1] in self.ending_ids:
+                    occurrences.clear()
+                else:
+                    occurrences[value[-1]] += 1
 
             # Try to end sentence on an already punctuated word.
-            if chars > max_chars - 70 and any(punct in self.values[-1] for punct in [".", "!", "?"]):
+            if chars > max_chars - 70 and values[-1] in self.punctuated_ids:
                 if self.debug:
-                    print("Ending on punctuated word:", self.values[-1])
+                    print("Ending on punctuated word:", self.vocabulary[values[-1]])
                 character_capped = True
 
+        return values
 
-        # TODO: move grammar stuff out of chain.
-
-        # Remove leading sentence whitespace, if present
-        if len(self.values[0]) > 0: # No idea why this would be zero, but it works.
-            if self.values[0][0] == " ":
-                self.values[0] = self.values[0][1:]
+    def count_occurrences(self, values, per_sentence=False):
+        """Return Counter of the word ids in values, or in their last sentence if per_sentence."""
+        if per_sentence:
+            for i in range(len(values) - 1, -1, -1):
+                if values[i] in self.ending_ids:
+                    values = values[i + 1:]
+                    break
 
-        #Capitalize first character in first word.
-        self.values[0] = self.values[0].title()
+        return Counter(values)
 
-    def instantiate_model(self, save=True):
-        """Build the model"""
+    def instantiate_model(self, documents, store=None, save=True, workers=None):
+        """
+        Build the model from corpus documents, a dict of names and signatures.
+        Documents are streamed a paragraph at a time and every paragraph is
+        counted in one pass, so only the model and one document are in memory.
+        With workers > 1, documents are split into shards counted in worker
+        processes, and the partial counts are merged in shard order.
+        Tokenized documents are written to store, if given.
+        """
         model = {}
 
-        for generator in self.generators:
-            model = self.expand_model(model, generator)
+        if workers is not None and workers > 1 and len(documents) > 1:
+            names = list(documents)
+            # A few shards per worker evens out documents of different sizes.
+            shard_size = -(-len(names) // (workers * 4))
+            shards = [names[i:i + shard_size] for i in range(0, len(names), shard_size)]
+
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                counted = executor.map(_count_documents, repeat(self.corpus_path),
+                                       repeat(self.complexity), shards)
+                for vocabulary, counts, tokenized in counted:
+                    remap = self.intern(vocabulary)
+                    self.merge_model(model, counts, remap)
+
+                    if store is not None:
+                        for name, paragraphs in tokenized.items():
+                            paragraphs = [[remap[i] for i in paragraph] for paragraph in paragraphs]
+                            store.write(name, documents[name], paragraphs)
+        else:
+            for name, document in self.read_documents(documents):
+                paragraphs = list()
+                for paragraph in document:
+                    self.expand_model(model, paragraph)
+                    paragraphs.append(paragraph)
+
+                if store is not None:
+                    store.write(name, documents[name], paragraphs)
+
+        if self.pruning:
+            report = markov_model.prune_model(model, **self.pruning)
+            self.print_prune_report(report, detail=self.debug)
+
+        model = markov_model.freeze_model(model)
 
         if save:
-            if not os.path.exists("models"):
-                os.makedirs("models")
-            with open("models/markov_dict.txt", "w") as file:
-                for key, value in model.items():
-                    file.write('%s:%s\n' % (key, value))
+            markov_model.save_model(self.model_path, model, self.vocabulary, self.fingerprint)
 
         return model
 
     @staticmethod
-    def expand_model(model, corpus_generator):
-        """Expand the markov model with multi or single keys."""
-        expanded_model = model
-        for string in corpus_generator:
-            multi = ' '.join(string)
-            key = ' '.join(multi.split(' ')[:-1])
-            value = multi.split(' ')[-1]
-
-            # If the key exists, put value in that key, or just add to count if value exists.
-            # If key doesn't exist, append it.
-            if key in expanded_model.keys():
-                if value in expanded_model[key].keys():
-                    expanded_model[key][value] += 1
+    def print_prune_report(report, detail=False):
+        """
+        Print keys, successors and counts kept in total, from model.prune_model.
+        The totals of every key length are also printed if detail is set.
+        The report goes to stderr, leaving stdout to generated sentences.
+        """
+        def kept(totals):
+            return ", ".join("%d/%d %s (%.0f%%)" % (after, before, total, 100 * after / max(before, 1))
+                             for total, (before, after) in totals.items())
+
+        overall = {"keys": [0, 0], "successors": [0, 0], "counts": [0, 0]}
+        print("Pruned model, kept:", file=sys.stderr)
+        for length, totals in report.items():
+            if detail:
+                print("  %2d words: %s" % (length, kept(totals)), file=sys.stderr)
+            for total, (before, after) in totals.items():
+                overall[total][0] += before
+                overall[total][1] += after
+        print("  total:    %s" % kept(overall), file=sys.stderr)
+
+    def draw(self, successors):
+        """Pick a successor at random, weighted by its count."""
+        steps, cumulative = successors
+        return steps[bisect_right(cumulative, self.rng.random() * cumulative[-1])]
+
+    def expand_model(self, model, paragraph):
+        """
+        Expand the markov model with the multi and single keys of a paragraph of word ids.
+        Keys of every length are counted in a single pass over the paragraph.
+        """
+        paragraph = tuple(paragraph)
+        length = len(paragraph)
+        for i in range(length - 2):
+            # Keys of 1 to complexity words starting at i, the word after being the value.
+            for end in range(i + 1, min(i + self.complexity, length - 2) + 1):
+                key = paragraph[i:end]
+                value = paragraph[end]
+
+                # If the key exists, put value in that key, or just add to count if value exists.
+                # If key doesn't exist, append it.
+                successors = model.get(key)
+                if successors is None:
+                    model[key] = {value: 1}
                 else:
-                    expanded_model[key][value] = 1
-            else:
-                expanded_model[key] = {value: 1}
-
-        return expanded_model
-
-
-    def create_model_generator(self, words_in_key):
-        """Yield a generator object from corpus with key-value single_key"""
-        for sub_list in self.corpus:
-            for i in range(len(sub_list) - words_in_key):
-                yield [sub_list[i+x] for x in range(words_in_key)]
+                    successors[value] = successors.get(value, 0) + 1
 
-
-    def walk(self):
+    @staticmethod
+    def merge_model(model, counts, remap):
+        """
+        Add partial counts to the markov model, both mapping keys to dicts of
+        successor counts. remap is the model's word id of every id in counts.
         """
-        Pick the next step at random
-        Each key appearance rate is turned into a probability.
-        Then a random key is selected at random, based on probability.
+        for key, successors in counts.items():
+            key = tuple([remap[i] for i in key])
+            merged = model.get(key)
+            if merged is None:
+                model[key] = merged = dict()
+            for value, count in successors.items():
+                value = remap[value]
+                merged[value] = merged.get(value, 0) + count
+
+    def walk(self, values):
         """
-        key_to_check = self.values[-1] # If no multikey is chosen, just use last word.
+        Pick the next step at random, after the word ids in values
+        A successor of the chosen key is drawn with probability
+        proportional to its appearance rate.
+        Return the word id of the step.
+        """
+        key_to_check = (values[-1],) # If no multikey is chosen, just use last word.
         multi_picked = False
         chance = None
-        denied_multi = ''
+        denied_multi = ()
         denying_multi = False
 
         for i in range(self.complexity, 1, -1):
             # If there are too few words to check for 'i' number of keys, skip.
-            if len(self.values) < i:
+            if len(values) < i:
                 continue
 
             # 90% base chance to pick multi-key.
@@ -279,37 +597,40 @@ class Chain():
             if chance < 60:
                 chance = 60
 
-            multi = ' '.join(self.values[-i:])
-            if randint(1, 100) < chance and (multi != denied_multi or not denying_multi):
-                if multi in self.model:
+            multi = tuple(values[-i:])
+            if self.rng.randint(1, 100) < chance and (multi != denied_multi or not denying_multi):
+                successors = self.model.get(multi)
+                if successors is not None:
+                    steps = successors[0]
                     # print("key<", multi, "> is in model.")
-                    if len(list(self.model[multi].keys())) > 3:
+                    if len(steps) > 3:
                         # print("90%")
                         chance = 90
-                    elif len(list(self.model[multi].keys())) > 1:
+                    elif len(steps) > 1:
                         # print("85%")
                         chance = 80
-                    elif len(list(self.model[multi].keys())) == 1 and list(self.model[multi].keys())[0] == self.values[-1]:
+                    elif len(steps) == 1 and steps[0] == values[-1]:
                         # print("0%")
                         chance = 0
                     else:
                         # print("45%")
                         chance = 30
 
-                    if randint(1, 100) < chance:
+                    if self.rng.randint(1, 100) < chance:
                         key_to_check = multi
                         multi_picked = True
                         if self.debug:
-                            print("Picking multi-key(" + str(i) + "):", key_to_check, "> ", end="")
+                            print("Picking multi-key(" + str(i) + "):",
+                                  ' '.join(self.words(key_to_check)), "> ", end="")
                         break
 
-            elif not denying_multi and randint(1, 100) > 78:
+            elif not denying_multi and self.rng.randint(1, 100) > 78:
                 denying_multi = True
-                denied_multi = ' '.join(multi.split()[1:])
+                denied_multi = multi[1:]
                 if self.debug:
-                    print("Denying multi with:", denied_multi)
+                    print("Denying multi with:", ' '.join(self.words(denied_multi)))
             else:
-                denied_multi = ' '.join(multi.split()[1:])
+                denied_multi = multi[1:]
 
 
         # TODO: Better handling of keys not being in base of model
@@ -317,31 +638,44 @@ class Chain():
             chain = self.model[key_to_check]
         except:
             # Just return a completely random key if key_to_check is not in base of model.
-            return np.random.choice(list(self.model.keys()))
-
-        keys = list(chain.keys())
+            return self.random_key()[-1]
 
-        # Calculate the normalizer, using: (1 / (sum of values))
-        normalizer = 1 / float(sum(chain.values()))
-
-        # Multiply each value by the normalizer
-        probabilities = [x * normalizer for x in chain.values()]
-
-        step = np.random.choice(keys, 1, p=probabilities)[0]
+        step = self.draw(chain)
 
         # Dont pick two numbers in a row.
-        if self.values[-1].isdigit() and len(self.model[step]) > 1:
-            while step.isdigit():
+        step_successors = self.model.get((step,))
+        if values[-1] in self.digit_ids and step_successors is not None and len(step_successors[0]) > 1:
+            while step in self.digit_ids:
                 # Small chance to just pick a random (non digit) word instead.
-                if randint(1, 100) > 99:
-                    step = np.random.choice(list(self.model.keys()), 1)[0]
+                if self.rng.randint(1, 100) > 99:
+                    step = self.random_key()[-1]
                 else:
-                    step = np.random.choice(keys, 1, p=probabilities)[0]
+                    step = self.draw(chain)
 
         if self.debug:
             if not multi_picked:
-                print("Picking single-key:", step)
+                print("Picking single-key:", self.vocabulary[step])
             else:
-                print(step)
+                print(self.vocabulary[step])
 
         return step
+
+
+def _count_documents(corpus_path, complexity, names):
+    """
+    Count the keys of a shard of corpus documents, in a worker process.
+    Return the shard's vocabulary, its dict of successor counts and the
+    paragraphs of every document, all in the shard's own word ids.
+    """
+    chain = Chain(corpus_path)
+    chain.complexity = complexity
+    model = {}
+    tokenized = dict()
+
+    for name in names:
+        tokenized[name] = list()
+        for paragraph in chain.read_document(name):
+            chain.expand_model(model, paragraph)
+            tokenized[name].append(paragraph)
+
+    return chain.vocabulary, model, tokenized
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+""" Single file corpus store """
+
+import os
+import hashlib
+import sqlite3
+
+STORE_SUFFIX = ".db"
+
+
+def is_corpus_store(corpus_path):
+    """Return whether a corpus path is a CorpusStore rather than text files."""
+    return corpus_path.endswith(STORE_SUFFIX)
+
+
+class CorpusStore():
+    """
+    Corpus documents in one SQLite file instead of a text file per page.
+    Documents are keyed by the name their text file would have, so change
+    sets are the same for both. Every document keeps the title and revision
+    of its page, and a signature that changes with its content.
+    The connection is opened on first use, so a store can be created
+    before worker processes are forked, as long as it isn't used yet.
+    Only a store opened with create makes a missing file, reading one that
+    doesn't exist raises FileNotFoundError, like a missing corpus folder.
+    Writes and removals are kept in one transaction until commit.
+    """
+    def __init__(self, path, create=False):
+        self.path = path
+        self.create = create
+        self.connection = None
+
+    def connect(self):
+        """Return the connection to the store file, creating its table if new."""
+        if self.connection is None:
+            if not self.create and not os.path.isfile(self.path):
+                raise FileNotFoundError("No corpus store at " + self.path)
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "name TEXT PRIMARY KEY, title TEXT, revid INTEGER, timestamp TEXT, "
+                "signature TEXT, content TEXT)")
+
+        return self.connection
+
+    def documents(self):
+        """Return dict of document names and signatures, like model.corpus_documents."""
+        rows = self.connect().execute("SELECT name, signature FROM documents ORDER BY rowid")
+        return dict(rows)
+
+    def __contains__(self, name):
+        row = self.connect().execute("SELECT 1 FROM documents WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def read(self, name):
+        """Return text of a document, or None if it isn't stored."""
+        row = self.connect().execute("SELECT content FROM documents WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def contents(self):
+        """Yield name and text of every document, in one sequential read."""
+        yield from self.connect().execute("SELECT name, content FROM documents ORDER BY rowid")
+
+    def write(self, name, title, revision, content):
+        """Add or replace the text of a document, from a page revision dict of 'revid' and 'timestamp'."""
+        signature = '%s:%s' % (revision.get("revid"), hashlib.sha1(content.encode('utf8')).hexdigest())
+        self.connect().execute(
+            "INSERT INTO documents (name, title, revid, timestamp, signature, content) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET "
+            "title = excluded.title, revid = excluded.revid, timestamp = excluded.timestamp, "
+            "signature = excluded.signature, content = excluded.content",
+            (name, title, revision.get("revid"), revision.get("timestamp"), signature, content))
+
+    def remove(self, name):
+        """Remove a document."""
+        self.connect().execute("DELETE FROM documents WHERE name = ?", (name,))
+
+    def commit(self):
+        """Commit the writes and removals made since the last commit."""
+        if self.connection is not None:
+            self.connection.commit()
+
+    def close(self):
+        """Close the connection, if open. Uncommitted writes are discarded."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+""" Markov model persistence """
+
+import gc
+import os
+import json
+import shutil
+import hashlib
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import accumulate, chain
+import numpy as np
+
+from src.corpus_store import CorpusStore, is_corpus_store
+import src.base as base
+
+MODEL_FORMAT = 3
+
+
+def corpus_documents(corpus_path):
+    """
+    Return dict of corpus document names and their size/mtime signature,
+    or the signatures kept by a CorpusStore.
+    """
+    documents = dict()
+
+    if is_corpus_store(corpus_path):
+        store = CorpusStore(corpus_path)
+        documents = store.documents()
+        store.close()
+    elif os.path.isdir(corpus_path):
+        for (dirpath, _, filenames) in os.walk(corpus_path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                documents[os.path.relpath(path, corpus_path)] = '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+    else:
+        stat = os.stat(corpus_path)
+        documents[os.path.basename(corpus_path)] = '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+
+    return documents
+
+
+def corpus_fingerprint(documents, complexity, pruning=None):
+    """Return a hash identifying the state of the corpus documents, and how the model is pruned."""
+    digest = hashlib.sha1()
+    digest.update(('%d:%d\n' % (MODEL_FORMAT, complexity)).encode('utf8'))
+    if pruning:
+        digest.update((json.dumps(pruning, sort_keys=True) + '\n').encode('utf8'))
+
+    for name in sorted(documents):
+        digest.update(('%s:%s\n' % (name, documents[name])).encode('utf8'))
+
+    return digest.hexdigest()
+
+
+def diff_documents(old, new):
+    """Return change set of document names between two corpus_documents() results."""
+    changes = {"added": [], "replaced": [], "removed": []}
+    for name, signature in new.items():
+        if name not in old:
+            changes["added"].append(name)
+        elif old[name] != signature:
+            changes["replaced"].append(name)
+
+    changes["removed"] = [name for name in old if name not in new]
+
+    return changes
+
+
+def save_model(path, model, vocabulary, fingerprint):
+    """
+    Save a FrozenModel, keyed by tuples of ids into vocabulary, as a directory
+    of flat arrays that can be memory mapped.
+
+    vocabulary.npy          utf8 words separated by newlines, in id order.
+    keys.npy                Word ids (+1, zero padded) of every key, one row per key,
+                            big-endian so rows sort and compare bytewise.
+    successor_offsets.npy   CSR offsets of every key's successors.
+    successor_tokens.npy    Word id of each successor.
+    successor_cumulative.npy  Running count of the successors of each key.
+    """
+    key_rows = model.sorted_keys
+    width = max((len(row) for row in key_rows), default=1)
+    # Frozen keys are already sorted, and so are their rows.
+    keys = _key_rows(key_rows, width)
+
+    successors = [model[key] for key in key_rows]
+    successor_offsets = np.zeros(len(successors) + 1, dtype=np.int64)
+    successor_offsets[1:] = np.cumsum([len(steps) for steps, _ in successors])
+    successor_tokens = np.fromiter(chain.from_iterable(steps for steps, _ in successors),
+                                   dtype=np.int32, count=successor_offsets[-1])
+    successor_cumulative = np.fromiter(chain.from_iterable(cumulative for _, cumulative in successors),
+                                       dtype=np.int64, count=successor_offsets[-1])
+
+    _write_model(path, vocabulary, fingerprint, keys, successor_offsets, successor_tokens, successor_cumulative)
+
+
+def update_saved_model(path, added, removed, vocabulary, fingerprint):
+    """
+    Add and subtract successor counts, dicts of counts by key like those of
+    Chain.expand_model, in the model saved at path, and save it with a new
+    vocabulary and fingerprint.
+    The counts are merged into the saved arrays, without loading the model,
+    so the work beyond copying the arrays grows with the changed counts.
+    Counted successors keep their order, new ones follow them.
+    Successors whose count drops to zero are removed, and so are keys
+    without successors.
+    """
+    keys = np.load(os.path.join(path, 'keys.npy'))
+    successor_offsets = np.load(os.path.join(path, 'successor_offsets.npy'))
+    successor_tokens = np.load(os.path.join(path, 'successor_tokens.npy'))
+    successor_cumulative = np.load(os.path.join(path, 'successor_cumulative.npy'))
+
+    # Running counts back into plain counts, restarting at every key.
+    successor_counts = np.diff(successor_cumulative, prepend=0)
+    starts = successor_offsets[:-1][np.diff(successor_offsets) > 0]
+    successor_counts[starts] = successor_cumulative[starts]
+
+    changed_keys = list()
+    changed_steps = list()
+    changed_counts = list()
+    for sign, counts in ((1, added), (-1, removed)):
+        for key, successors in counts.items():
+            for step, count in successors.items():
+                changed_keys.append(key)
+                changed_steps.append(step)
+                changed_counts.append(sign * count)
+    if not changed_keys:
+        _write_model(path, vocabulary, fingerprint, keys, successor_offsets, successor_tokens,
+                     successor_cumulative)
+        return
+
+    width = max(keys.shape[1], max(map(len, changed_keys)))
+    if width > keys.shape[1]:
+        keys = np.pad(keys, ((0, 0), (0, width - keys.shape[1])))
+    rows = keys.view('V%d' % (4 * width)).ravel()
+
+    # Insert the changed keys that are new among the saved ones, and find
+    # where every saved and changed key ends up.
+    changed_rows = _key_rows(changed_keys, width).view('V%d' % (4 * width)).ravel()
+    changed_rows, changed_key_indices = np.unique(changed_rows, return_inverse=True)
+    positions = np.searchsorted(rows, changed_rows)
+    saved = np.zeros(len(changed_rows), dtype=bool)
+    inside = positions < len(rows)
+    saved[inside] = rows[positions[inside]] == changed_rows[inside]
+    new_positions = positions[~saved]
+    keys = np.insert(keys, new_positions, changed_rows[~saved].view('>u4').reshape(-1, width), axis=0)
+
+    key_indices = np.arange(len(rows)) + np.searchsorted(new_positions, np.arange(len(rows)), side='right')
+    changed_indices = np.empty(len(changed_rows), dtype=np.int64)
+    changed_indices[saved] = key_indices[positions[saved]]
+    changed_indices[~saved] = new_positions + np.arange(len(new_positions))
+
+    # Sum the changes of every key and successor pair, as key index * vocabulary size + successor id.
+    size = len(vocabulary)
+    codes, pair_indices = np.unique(changed_indices[changed_key_indices.ravel()] * size
+                                    + np.array(changed_steps, dtype=np.int64), return_inverse=True)
+    deltas = np.zeros(len(codes), dtype=np.int64)
+    np.add.at(deltas, pair_indices.ravel(), changed_counts)
+
+    # Apply them to the saved successors of changed keys.
+    entry_keys = key_indices[np.repeat(np.arange(len(rows)), np.diff(successor_offsets))]
+    touched = np.zeros(len(keys), dtype=bool)
+    touched[codes // size] = True
+    candidates = np.flatnonzero(touched[entry_keys])
+    candidate_codes = entry_keys[candidates] * size + successor_tokens[candidates]
+    order = np.argsort(candidate_codes)
+    found = np.searchsorted(candidate_codes[order], codes)
+    counted = np.zeros(len(codes), dtype=bool)
+    inside = found < len(order)
+    counted[inside] = candidate_codes[order[found[inside]]] == codes[inside]
+    successor_counts[candidates[order[found[counted]]]] += deltas[counted]
+
+    # Drop successors no longer counted, and insert new ones after the saved ones of their key.
+    kept = successor_counts > 0
+    entry_keys = entry_keys[kept]
+    successor_tokens = successor_tokens[kept]
+    successor_counts = successor_counts[kept]
+    new = ~counted & (deltas > 0)
+    new_keys = codes[new] // size
+    insertions = np.searchsorted(entry_keys, new_keys, side='right')
+    entry_keys = np.insert(entry_keys, insertions, new_keys)
+    successor_tokens = np.insert(successor_tokens, insertions, codes[new] % size)
+    successor_counts = np.insert(successor_counts, insertions, deltas[new])
+
+    # Drop keys without successors, and count the rest back into offsets and running counts.
+    lengths = np.bincount(entry_keys, minlength=len(keys))
+    keys = keys[lengths > 0]
+    lengths = lengths[lengths > 0]
+    successor_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    successor_offsets[1:] = np.cumsum(lengths)
+    running = np.cumsum(successor_counts)
+    before = np.concatenate(([0], running))[successor_offsets[:-1]]
+    successor_cumulative = running - np.repeat(before, lengths)
+
+    _write_model(path, vocabulary, fingerprint, keys, successor_offsets, successor_tokens, successor_cumulative)
+
+
+def _key_rows(key_tuples, width):
+    """Return array of key tuples as padded rows of word ids + 1, like keys.npy."""
+    keys = np.zeros((len(key_tuples), width), dtype='>u4')
+
+    # Fill rows grouped by length, a whole group at a time.
+    rows_by_length = defaultdict(list)
+    for k, row in enumerate(key_tuples):
+        rows_by_length[len(row)].append(k)
+    for length, indices in rows_by_length.items():
+        group = np.array(list(chain.from_iterable(key_tuples[k] for k in indices)), dtype=np.uint32)
+        keys[indices, :length] = group.reshape(-1, length) + 1
+
+    return keys
+
+
+def _write_model(path, vocabulary, fingerprint, keys, successor_offsets, successor_tokens, successor_cumulative):
+    """Write the arrays of a model to path, see save_model."""
+    # Write to a temporary directory first, so a crash never leaves a broken model behind.
+    # Processes still mapping the old model keep their (unlinked) files.
+    tmp_path = path + '.tmp'
+    old_path = path + '.old'
+    for stale in (tmp_path, old_path):
+        if os.path.exists(stale):
+            shutil.rmtree(stale)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, 'vocabulary.npy'),
+            np.frombuffer('\n'.join(vocabulary).encode('utf8'), dtype=np.uint8))
+    np.save(os.path.join(tmp_path, 'keys.npy'), keys)
+    np.save(os.path.join(tmp_path, 'successor_offsets.npy'), successor_offsets)
+    np.save(os.path.join(tmp_path, 'successor_tokens.npy'), successor_tokens)
+    np.save(os.path.join(tmp_path, 'successor_cumulative.npy'), successor_cumulative)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump({'format': MODEL_FORMAT, 'fingerprint': fingerprint}, file)
+
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def read_fingerprint(path):
+    """Return fingerprint of the model saved at path, or None if there is no usable model."""
+    try:
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('format') != MODEL_FORMAT:
+        return None
+
+    return meta.get('fingerprint')
+
+
+def prune_model(model, min_count=1, max_successors=None, deterministic=False):
+    """
+    Prune a model dict of successor counts in place, before it is frozen.
+    Only keys of more than one word are pruned, so every word keeps all
+    its successors and a walk can always back off to a single word key.
+
+    deterministic   Drop keys with a single successor that the key without
+                    its first word also has as its only successor. A walk
+                    backing off to the shorter key draws the same step.
+    min_count       Drop successors counted fewer times.
+    max_successors  Keep only this many of the most counted successors.
+
+    Return report dict of key, successor and count totals per key length,
+    each a [before, after] pair. The share of counts kept is how much of
+    the observed text the pruned keys still reproduce.
+    """
+    report = defaultdict(lambda: {"keys": [0, 0], "successors": [0, 0], "counts": [0, 0]})
+    for key, successors in model.items():
+        totals = report[len(key)]
+        totals["keys"][0] += 1
+        totals["successors"][0] += len(successors)
+        totals["counts"][0] += sum(successors.values())
+
+    # Decided on the unpruned counts, so a dropped key always backs off to a
+    # shorter key with the same successor.
+    if deterministic:
+        dropped = [key for key, successors in model.items()
+                   if len(key) > 1 and len(successors) == 1
+                   and len(model.get(key[1:], ())) == 1 and model[key[1:]].keys() == successors.keys()]
+        for key in dropped:
+            del model[key]
+
+    for key in list(model):
+        if len(key) == 1:
+            continue
+
+        successors = model[key]
+        if min_count > 1:
+            successors = {step: count for step, count in successors.items() if count >= min_count}
+        if max_successors is not None and len(successors) > max_successors:
+            kept = set(sorted(successors, key=successors.get, reverse=True)[:max_successors])
+            successors = {step: successors[step] for step in successors if step in kept}
+
+        if successors:
+            model[key] = successors
+        else:
+            del model[key]
+
+    for key, successors in model.items():
+        totals = report[len(key)]
+        totals["keys"][1] += 1
+        totals["successors"][1] += len(successors)
+        totals["counts"][1] += sum(successors.values())
+
+    return dict(sorted(report.items()))
+
+
+def freeze_model(model):
+    """
+    Return FrozenModel with every dict of successor counts turned into a
+    (successors, cumulative counts) pair of tuples, ready for sampling.
+    Counts are removed from model as they are frozen, so the two are
+    never both held in full.
+    """
+    frozen = FrozenModel()
+    for key in sorted(model):
+        successors = model.pop(key)
+        frozen[key] = (tuple(successors), tuple(accumulate(successors.values())))
+    frozen.sorted_keys = list(frozen)
+
+    return frozen
+
+
+class FrozenModel(dict):
+    """
+    Model dict of (successors, cumulative counts) pairs, with keys in sorted order.
+    Keys sharing a prefix are next to each other in the sorted order,
+    so they can be found by bisecting instead of scanning every key.
+    A loaded model has its key table from the saved arrays.
+    """
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.sorted_keys = list(self)
+        self.table = None
+
+    def key(self, index):
+        """Return key at index in sorted order."""
+        return self.sorted_keys[index]
+
+    def key_table(self):
+        """Return arrays of the first word id, length and number of successors of every key."""
+        if self.table is not None:
+            return self.table
+
+        first_words = np.fromiter((key[0] for key in self.sorted_keys), dtype=np.int64, count=len(self))
+        lengths = np.fromiter(map(len, self.sorted_keys), dtype=np.int64, count=len(self))
+        successor_counts = np.fromiter((len(successors[0]) for successors in self.values()),
+                                       dtype=np.int64, count=len(self))
+        return first_words, lengths, successor_counts
+
+    def prefix_range(self, prefix):
+        """Return (start, end) indices of the keys that are longer than and begin with prefix."""
+        start = bisect_right(self.sorted_keys, prefix)
+        end = bisect_left(self.sorted_keys, prefix[:-1] + (prefix[-1] + 1,))
+        return start, end
+
+
+def load_model(path, fingerprint=None):
+    """
+    Load model saved by save_model into a FrozenModel.
+    Return None if there is no model or its fingerprint doesn't match.
+    """
+    saved_fingerprint = read_fingerprint(path)
+    if saved_fingerprint is None or (fingerprint is not None and saved_fingerprint != fingerprint):
+        return None
+
+    # Building millions of tuples would trigger needless garbage collections.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return _load_frozen(path)
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def _load_frozen(path):
+    """Return saved model as a FrozenModel, see load_model."""
+    successor_offsets = np.load(os.path.join(path, 'successor_offsets.npy'))
+    bounds = list(zip(successor_offsets[:-1].tolist(), successor_offsets[1:].tolist()))
+
+    # Slicing tuples gives tuples, without copying every slice into a new one.
+    successor_tokens = tuple(np.load(os.path.join(path, 'successor_tokens.npy')).tolist())
+    successor_cumulative = tuple(np.load(os.path.join(path, 'successor_cumulative.npy')).tolist())
+    steps = [successor_tokens[start:end] for start, end in bounds]
+    cumulative = [successor_cumulative[start:end] for start, end in bounds]
+
+    # Keys are saved in sorted order.
+    keys = np.load(os.path.join(path, 'keys.npy'))
+    model = FrozenModel(zip(_load_key_tuples(keys), zip(steps, cumulative)))
+    model.table = (keys[:, 0].astype(np.int64) - 1, np.count_nonzero(keys, axis=1), np.diff(successor_offsets))
+
+    return model
+
+
+def _load_key_tuples(keys):
+    """Return list of the saved keys array as tuples of word ids."""
+    # Id 0 is padding, so word ids are shifted by one. Rows of each length are
+    # unpadded together, and their tuples zipped from columns of ids.
+    lengths = np.count_nonzero(keys, axis=1)
+    order = np.argsort(lengths, kind='stable')
+    grouped = list()
+    for indices in np.split(order, np.flatnonzero(np.diff(lengths[order])) + 1):
+        if len(indices):
+            length = int(lengths[indices[0]])
+            rows = keys[indices, :length].astype(np.int64) - 1
+            grouped.extend(zip(*(rows[:, column].tolist() for column in range(length))))
+
+    # Put the tuples back in the saved order.
+    positions = np.empty(len(order), dtype=np.int64)
+    positions[order] = np.arange(len(order))
+    return [grouped[k] for k in positions.tolist()]
+
+
+def load_vocabulary(path):
+    """Return list of words in the saved vocabulary, in id order."""
+    data = np.load(os.path.join(path, 'vocabulary.npy'), mmap_mode='r')
+    return bytes(data).decode('utf8').split('\n')
+
+
+class MappedModel():
+    """
+    Read-only model backed by memory mapped arrays.
+    Processes mapping the same model share its pages instead of each
+    holding a copy. Keys and successors behave as in a frozen dict model.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fingerprint = read_fingerprint(path)
+        if self.fingerprint is None:
+            raise FileNotFoundError("No usable model at " + path)
+
+        self.vocabulary = load_vocabulary(path)
+        self.keys_array = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.width = self.keys_array.shape[1]
+        self.rows = self.keys_array.view('V%d' % (4 * self.width)).ravel()
+        self.successor_offsets = np.load(os.path.join(path, 'successor_offsets.npy'), mmap_mode='r')
+        self.successor_tokens = np.load(os.path.join(path, 'successor_tokens.npy'), mmap_mode='r')
+        self.successor_cumulative = np.load(os.path.join(path, 'successor_cumulative.npy'),
+                                            mmap_mode='r')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        index = self._find(key)
+        if index is None:
+            raise KeyError(key)
+        return self.successors(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.key(index)
+
+    def get(self, key, default=None):
+        """Return successors of key, or default if key is missing."""
+        index = self._find(key)
+        if index is None:
+            return default
+        return self.successors(index)
+
+    def keys(self):
+        """Iterate all keys in sorted order."""
+        return iter(self)
+
+    def key(self, index):
+        """Return key tuple at index."""
+        return tuple([t - 1 for t in self.keys_array[index].tolist() if t])
+
+    def successors(self, index):
+        """Return (successors, cumulative counts) of key at index."""
+        start, end = int(self.successor_offsets[index]), int(self.successor_offsets[index + 1])
+        return (self.successor_tokens[start:end].tolist(), self.successor_cumulative[start:end].tolist())
+
+    def key_table(self):
+        """Return arrays of the first word id, length and number of successors of every key."""
+        first_words = self.keys_array[:, 0].astype(np.int64) - 1
+        lengths = np.count_nonzero(self.keys_array, axis=1)
+        successor_counts = np.diff(self.successor_offsets)
+        return first_words, lengths, successor_counts
+
+    def prefix_range(self, prefix):
+        """Return (start, end) indices of the keys that are longer than and begin with prefix."""
+        if len(prefix) >= self.width:
+            return 0, 0
+
+        start = int(np.searchsorted(self.rows, self._row(prefix), side='right'))
+        end = int(np.searchsorted(self.rows, self._row(prefix[:-1] + (prefix[-1] + 1,)), side='left'))
+        return start, end
+
+    def _row(self, key):
+        """Return key as a padded row, comparable with the saved rows."""
+        row = np.zeros(self.width, dtype='>u4')
+        row[:len(key)] = key
+        row[:len(key)] += 1
+        return row.view('V%d' % (4 * self.width))[0]
+
+    def _find(self, key):
+        """Return index of key, or None if it isn't in the model."""
+        if len(key) > self.width or not all(isinstance(value, int) for value in key):
+            return None
+
+        needle = self._row(key)
+        index = int(np.searchsorted(self.rows, needle))
+        if index < len(self.rows) and self.rows[index] == needle:
+            return index
+        return None
+
+
+class DocumentStore():
+    """
+    Append-only store of the tokenized documents a model was built from.
+    Keeps every document's contribution, so changed documents can be
+    subtracted from the model without re-reading the whole corpus.
+    Replaced documents leave dead entries behind until compact() or reset().
+    """
+    def __init__(self, path):
+        self.index_path = path + '.json'
+        self.data_path = path + '.jsonl'
+        self.fingerprint = None
+        self.index = dict()     # name: [signature, offset, length]
+
+    def load(self):
+        """Load the index, return False if there is none."""
+        try:
+            with open(self.index_path, encoding='utf8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return False
+
+        self.fingerprint = data["fingerprint"]
+        self.index = data["documents"]
+        return os.path.isfile(self.data_path)
+
+    def save(self, fingerprint):
+        """Save the index, marking the store as belonging to the model with fingerprint."""
+        self.fingerprint = fingerprint
+        base.write_json(self.index_path, {"fingerprint": fingerprint, "documents": self.index})
+
+    def compact(self):
+        """
+        Rewrite the stored documents without dead entries, once these take more
+        space than the live ones. Until the rewrite is saved the store belongs
+        to no model, so a crash leaves the model to be rebuilt.
+        Return whether the documents were rewritten.
+        """
+        live = sum(length for _, _, length in self.index.values())
+        if os.path.getsize(self.data_path) <= 2 * live:
+            return False
+
+        fingerprint = self.fingerprint
+        index = dict()
+        with open(self.data_path, 'rb') as source, open(self.data_path + '.tmp', 'wb') as target:
+            for name, (signature, offset, length) in sorted(self.index.items(), key=lambda item: item[1][1]):
+                source.seek(offset)
+                index[name] = [signature, target.tell(), length]
+                target.write(source.read(length))
+
+        self.save(None)
+        os.replace(self.data_path + '.tmp', self.data_path)
+        self.index = index
+        self.save(fingerprint)
+        return True
+
+    def reset(self):
+        """Remove all documents."""
+        directory = os.path.dirname(self.data_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        open(self.data_path, 'w').close()
+        self.index = dict()
+
+    def signatures(self):
+        """Return dict of stored document names and signatures."""
+        return {name: entry[0] for name, entry in self.index.items()}
+
+    def read(self, name):
+        """Return stored paragraphs of document."""
+        _, offset, length = self.index[name]
+        with open(self.data_path, 'rb') as file:
+            file.seek(offset)
+            return json.loads(file.read(length).decode('utf8'))
+
+    def write(self, name, signature, paragraphs):
+        """Append document, replacing any stored version."""
+        data = (json.dumps(paragraphs, ensure_ascii=False) + '\n').encode('utf8')
+        with open(self.data_path, 'ab') as file:
+            offset = file.tell()
+            file.write(data)
+        self.index[name] = [signature, offset, len(data)]
+
+    def remove(self, name):
+        """Forget document."""
+        del self.index[name]
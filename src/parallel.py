@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+""" Parallel sentence generation """
+
+import multiprocessing
+from random import Random
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from src.chain import Chain
+from src.sentence import Sentence
+
+_chain = None   # Chain of this worker process.
+
+
+def generate_parallel(chain, count, max_characters, first_word=None, workers=None, seed=None,
+                      chunk_size=16):
+    """
+    Yield count sentence strings, generated across a pool of worker processes.
+    Sentences are yielded in order. Every chunk of chunk_size sentences gets
+    its own random stream derived from seed, so a seed gives the same
+    sentences whatever the number of workers. With one worker the chunks
+    are generated in this process, the same way.
+    chain must have a built model. Forked workers inherit it, others map
+    the saved model.
+    """
+    base_seed = np.random.SeedSequence(seed)
+    tasks = list()
+    for index, start in enumerate(range(0, count, chunk_size)):
+        chunk_seed = np.random.SeedSequence(base_seed.entropy, spawn_key=(index,))
+        tasks.append((chunk_seed, min(chunk_size, count - start), max_characters, first_word))
+
+    if workers is not None and workers <= 1:
+        rng = chain.rng
+        try:
+            for task in tasks:
+                yield from _generate_chunk(chain, task)
+        finally:
+            chain.rng = rng
+        return
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        initargs = (chain, None)
+    else:
+        context = multiprocessing.get_context()
+        initargs = (None, chain.model_path)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=initargs) as executor:
+        for sentences in executor.map(_generate, tasks):
+            for sentence in sentences:
+                yield sentence
+
+
+def _init_worker(chain, model_path):
+    """Set the chain of this worker, mapping the saved model if it wasn't inherited."""
+    global _chain
+    if chain is None:
+        chain = Chain(None, mmap=True)
+        chain.load_model(model_path)
+    _chain = chain
+
+
+def _generate(task):
+    """Return list of sentence strings for one chunk of generate_parallel, in a worker."""
+    return _generate_chunk(_chain, task)
+
+
+def _generate_chunk(chain, task):
+    """Return list of sentence strings for one chunk, from the chunk's own random stream."""
+    chunk_seed, count, max_characters, first_word = task
+    chain.rng = Random(chunk_seed.generate_state(1)[0].item())
+
+    return [str(sentence) for sentence in Sentence.generate_batch(chain, count, max_characters, first_word)]
@@ -3,17 +3,27 @@
 
 import re
 import os
-from random import randint
+from collections import Counter
+
+import src.base as base
+
+# Removed from the last word when looking for a trailing conjunction.
+WORD_PUNCTUATION = str.maketrans(dict.fromkeys("-,.?!()\"“”:'[]"))
+PUNCTUATION_WORD = re.compile(r'(?<=[.,!?()])([\w\d])(?! )')
+ENDINGS = frozenset(".!?")
+
 
 class Sentence():
     """Sentence generator"""
 
-    def __init__(self, chain, max_characters, filters=None):
+    def __init__(self, chain, max_characters, filters=None, rng=None):
         self.chain = chain  # Initialized Markov self.chain object.
+        self.rng = rng if rng is not None else chain.rng  # Same as the chain's, unless given.
         self.words = None
         self.string = ""
         self.max_characters = max_characters
-        self.max_word_occurrence = 6    # TODO: should be per sentence, not whole chain. (split on ".!?")
+        self.max_word_occurrence = 6
+        self.occurrence_per_sentence = False    # Count occurrences per sentence (split on ".!?"), not whole chain.
         if filters is not None:
             self.filters = filters  # Applied in order listed.
         else:
@@ -25,9 +35,21 @@ class Sentence():
                             "random_trailing_punctuation",
                             "capitalize_names"]
 
-        with open('conjunctions.txt', 'r') as file:
-            self.conjunctions = file.read().split("\n")
-
+        self.conjunctions = base.read_set('conjunctions.txt')
+
+    @classmethod
+    def generate_batch(cls, chain, count, max_characters, first_word=None, filters=None):
+        """
+        Yield count independently generated sentences from one loaded chain.
+        max_characters is a number, or a (min, max) range to pick every sentence's length from.
+        """
+        for _ in range(count):
+            if isinstance(max_characters, tuple):
+                sentence = cls(chain, chain.rng.randint(*max_characters), filters)
+            else:
+                sentence = cls(chain, max_characters, filters)
+            sentence.generate(first_word)
+            yield sentence
 
     def generate(self, first_word=None):
         """Generate senctances until one is deemed worthy.."""
@@ -37,89 +59,128 @@ class Sentence():
             while not completed:
                 try:
                     # print("Generating a tweet of max", self.max_characters, "characters...")
-                    self.chain.generate(self.max_characters, first_word)
+                    values = self.chain.generate(self.max_characters, first_word, self.max_word_occurrence,
+                                                 self.occurrence_per_sentence)
                     completed = True
                 except BaseException as exception:
                     print("Error in sentence.generate", str(exception))
 
-            too_many_word_occurences = False
+            # The chain keeps to max_word_occurrence while generating, unless it had to give up.
+            too_many_word_occurences = self._too_repetitive(values)
 
-            # print(' '.join(self.chain.values))
-            for word in self.chain.values:
-                count_occurrences = self.chain.values.count(word)
-                if count_occurrences > self.max_word_occurrence:
-                    too_many_word_occurences = True
-                    break
+        # Word ids become words here, and nowhere before.
+        self.words = self.chain.words(values)
+
+        # Remove leading sentence whitespace, if present
+        if len(self.words[0]) > 0: # No idea why this would be zero, but it works.
+            if self.words[0][0] == " ":
+                self.words[0] = self.words[0][1:]
+
+        #Capitalize first character in first word.
+        self.words[0] = self.words[0].title()
 
-        self.words = self.chain.values
-        self.string = ' '.join(self.words)
         self._apply_filters()
 
+    def _too_repetitive(self, values):
+        """Return whether a word id occurs more than max_word_occurrence times, in values or one of its sentences."""
+        occurrences = Counter()
+        for value in values:
+            occurrences[value] += 1
+            if occurrences[value] > self.max_word_occurrence:
+                return True
+            if self.occurrence_per_sentence and value in self.chain.ending_ids:
+                occurrences.clear()
+
+        return False
+
     def __str__(self):
         """Printable"""
         return self.string
 
     def _apply_filters(self):
-        """Apply selected filters"""
-        filter_functions = {
-            'trailing_conjunction': self._trailing_conjunction,
-            'trailing_commas': self._trailing_commas,
-            'punctuation_whitespace': self._punctuation_whitespace,
-            'punctuation_capitalization': self._punctuation_capitalization,
-            'random_trailing_punctuation': self._random_trailing_punctuation,
-            'capitalize_names': self._capitalize_names
-        }
-
-        # Call functions based on filter name.
+        """
+        Apply selected filters, in one pass over the words of the sentence.
+        Filters are names in FILTERS, or filter functions.
+        """
+        tokens = ' '.join(self.words).split()
         for current_filter in self.filters:
-            filter_functions[current_filter]()
-
-
-    def _trailing_conjunction(self):
-        """Remove conjunction if present at end of sentence."""
-        last_word = re.sub(r"[\-\,\.\?\!\(\)\"\“\”\:\'\[\]]", '', self.words[-1])
-        b = last_word in self.conjunctions
-        while last_word in self.conjunctions:
-            del self.words[-1]
-            last_word = re.sub(r"[\-\,\.\?\!\(\)\"\“\”\:\'\[\]]", '', self.words[-1])
-
-        self.string = ' '.join(self.words)
-
-    def _trailing_commas(self):
-        """Remove trailing comma, if present."""
-        if self.string[-1] == ",":
-            self.string = self.string[:-2]
-
-    def _punctuation_whitespace(self):
-        """Make sure punctuations (That are followed by words) are followed by space."""
-        self.string = re.sub('(?<=[.,!?()])([\w\d])(?! )', r'\0 \1', self.string).strip()
-
-    def _punctuation_capitalization(self):
-        """Capitalize first letter of word after punctuation."""
-        words = self.string.split()
-        for idx in range(len(words) - 1):
-            if len(words[idx]) > 0:
-                if any(punct in words[idx] for punct in [".", "!", "?"]):
-                    words[idx+1] = words[idx+1].title()
-        self.string = ' '.join(words)
-
-    def _random_trailing_punctuation(self):
-        """Append random punctuation if missing (at end)."""
-        punctuations = [".", ".", ".", "!", "?"]
-        if self.string[-1] not in punctuations:
-            self.string += punctuations[randint(0, len(punctuations) - 1)]
-
-    def _capitalize_names(self):
-        """Capitalize names anywhere in sentence."""
-        if os.path.isfile("config/saved_users.txt"):
-            names = list()
-            with open('config/saved_users.txt', 'r') as file:
-                names = file.read().split("\n")
-
-            words = self.string.split()
-
-            for i in range(len(words) - 1):
-                if words[i] in names:
-                    words[i] = words[i].title()
-
-            self.string = ' '.join(words)
+            if not callable(current_filter):
+                current_filter = FILTERS[current_filter]
+            tokens = current_filter(self, tokens)
+
+        self.string = ' '.join(tokens)
+
+
+FILTERS = dict()    # Filter functions by name, see register_filter.
+
+
+def register_filter(name):
+    """
+    Decorator registering a filter function under name, for Sentence.filters.
+    A filter is called with the Sentence and its list of words, and returns
+    the filtered list of words.
+    """
+    def register(function):
+        FILTERS[name] = function
+        return function
+
+    return register
+
+
+@register_filter('trailing_conjunction')
+def trailing_conjunction(sentence, tokens):
+    """Remove conjunction if present at end of sentence."""
+    while tokens and tokens[-1].translate(WORD_PUNCTUATION) in sentence.conjunctions:
+        del tokens[-1]
+
+    return tokens
+
+
+@register_filter('trailing_commas')
+def trailing_commas(sentence, tokens):
+    """Remove trailing comma, if present."""
+    if tokens and tokens[-1].endswith(","):
+        tokens[-1] = tokens[-1][:-1]
+        if not tokens[-1]:
+            del tokens[-1]
+
+    return tokens
+
+
+@register_filter('punctuation_whitespace')
+def punctuation_whitespace(sentence, tokens):
+    """Make sure punctuations (That are followed by words) are followed by space."""
+    return [part for token in tokens for part in PUNCTUATION_WORD.sub(r'\0 \1', token).split()]
+
+
+@register_filter('punctuation_capitalization')
+def punctuation_capitalization(sentence, tokens):
+    """Capitalize first letter of word after punctuation."""
+    for idx in range(len(tokens) - 1):
+        if not ENDINGS.isdisjoint(tokens[idx]):
+            tokens[idx+1] = tokens[idx+1].title()
+
+    return tokens
+
+
+@register_filter('random_trailing_punctuation')
+def random_trailing_punctuation(sentence, tokens):
+    """Append random punctuation if missing (at end)."""
+    punctuations = [".", ".", ".", "!", "?"]
+    if tokens and tokens[-1][-1] not in punctuations:
+        tokens[-1] += punctuations[sentence.rng.randint(0, len(punctuations) - 1)]
+
+    return tokens
+
+
+@register_filter('capitalize_names')
+def capitalize_names(sentence, tokens):
+    """Capitalize names anywhere in sentence."""
+    if os.path.isfile("config/saved_users.txt"):
+        names = base.read_set("config/saved_users.txt")
+
+        for i in range(len(tokens) - 1):
+            if tokens[i] in names:
+                tokens[i] = tokens[i].title()
+
+    return tokens
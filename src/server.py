@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+""" Local generation server """
+
+import json
+import threading
+from random import Random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from src.sentence import Sentence
+
+MAX_COUNT = 100     # Most sentences generated per request.
+MAX_CHARACTERS = 1000   # Longest sentence, longer ones can't keep to the word repetition limit.
+
+
+class GenerationServer(ThreadingHTTPServer):
+    """
+    HTTP server answering generation requests from one loaded chain.
+    Clients are handled in their own threads, generation takes turns on the
+    chain, since its random generator is shared.
+
+    GET /generate?count=N&min=N&max=N&first_word=W&seed=N
+    Every parameter is optional. Answers {"sentences": [...]}, or
+    {"error": "..."} with status 400.
+    """
+    daemon_threads = True
+    request_queue_size = 64     # Clients connecting at once, beyond it connects are retried a second later.
+
+    def __init__(self, address, chain):
+        super().__init__(address, GenerationHandler)
+        self.chain = chain
+        self.lock = threading.Lock()
+
+    def generate(self, count, max_characters, first_word=None, seed=None):
+        """
+        Return list of count sentence strings. A seed gives the same sentences
+        for the same model, without seed the chain's own generator is used.
+        """
+        with self.lock:
+            rng = self.chain.rng
+            if seed is not None:
+                self.chain.rng = Random(seed)
+            try:
+                return [str(sentence) for sentence in
+                        Sentence.generate_batch(self.chain, count, max_characters, first_word)]
+            finally:
+                self.chain.rng = rng
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    """Request handler of GenerationServer."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Answer a generation request."""
+        url = urlparse(self.path)
+        if url.path != '/generate':
+            self.send_json(404, {"error": "Unknown path " + url.path})
+            return
+
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            count = int(query.get('count', 1))
+            max_characters = (int(query.get('min', 230)), int(query.get('max', 270)))
+            seed = int(query['seed']) if 'seed' in query else None
+        except ValueError:
+            self.send_json(400, {"error": "count, min, max and seed must be integers."})
+            return
+
+        if not 1 <= count <= MAX_COUNT or not 0 < max_characters[0] <= max_characters[1] <= MAX_CHARACTERS:
+            self.send_json(400, {"error": "count must be 1 to %d, and 0 < min <= max <= %d."
+                                          % (MAX_COUNT, MAX_CHARACTERS)})
+            return
+
+        sentences = self.server.generate(count, max_characters, query.get('first_word'), seed)
+        self.send_json(200, {"sentences": sentences})
+
+    def send_json(self, status, data):
+        """Send data as a JSON response."""
+        body = json.dumps(data, ensure_ascii=False).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests only when the chain is in debug mode."""
+        if self.server.chain.debug:
+            super().log_message(format, *args)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+""" Pool of pre-generated tweets """
+
+import os
+import json
+import threading
+
+from src.sentence import Sentence
+import src.base as base
+
+
+def distinct(sentence, pooled):
+    """Filter rejecting sentences already in the pool."""
+    return str(sentence) not in pooled
+
+
+def complete(sentence, pooled):
+    """Filter rejecting sentences not ending in punctuation."""
+    return str(sentence).endswith(('.', '!', '?'))
+
+
+class TweetPool():
+    """
+    Sentences generated and filtered ahead of posting, saved in a JSON file.
+    The pool belongs to the model fingerprint it was generated from, and is
+    emptied when used with another model.
+    Every filter is called with a candidate Sentence and the set of pooled
+    strings, and returns whether to keep it. Candidates failing a filter are
+    discarded, so filters can be as slow as needed off the posting path.
+    """
+    def __init__(self, path, size=20, max_characters=(180, 260), filters=(distinct, complete)):
+        self.path = path
+        self.size = size
+        self.max_characters = max_characters
+        self.filters = filters
+        self.lock = threading.Lock()
+        self.fingerprint = None
+        self.tweets = list()
+        self.load()
+
+    def __len__(self):
+        return len(self.tweets)
+
+    def load(self):
+        """Load the saved pool, if any."""
+        if os.path.isfile(self.path):
+            with open(self.path, encoding='utf8') as file:
+                saved = json.load(file)
+            self.fingerprint = saved["fingerprint"]
+            self.tweets = saved["tweets"]
+
+    def save(self):
+        """Save the pool with base.write_json."""
+        base.write_json(self.path, {"fingerprint": self.fingerprint, "tweets": self.tweets})
+
+    def pop(self, fingerprint):
+        """Return the oldest pooled tweet generated from the fingerprinted model, or None if there is none."""
+        with self.lock:
+            if fingerprint != self.fingerprint or not self.tweets:
+                return None
+
+            tweet = self.tweets.pop(0)
+            self.save()
+
+            return tweet
+
+    def fill(self, chain):
+        """Generate and filter sentences from chain until the pool is full. Return the number added."""
+        with self.lock:
+            if chain.fingerprint != self.fingerprint:
+                self.fingerprint = chain.fingerprint
+                self.tweets = list()
+            missing = self.size - len(self.tweets)
+
+        # Candidates are filtered without holding the lock, so pops don't wait for filters.
+        added = 0
+        pooled = set(self.tweets)
+        candidates = Sentence.generate_batch(chain, missing * 10, self.max_characters)
+        for sentence in candidates:
+            if added == missing:
+                break
+            if not all(accept(sentence, pooled) for accept in self.filters):
+                continue
+
+            with self.lock:
+                # Another pool is being filled from a newer model, leave it to that.
+                if chain.fingerprint != self.fingerprint:
+                    break
+                self.tweets.append(str(sentence))
+            pooled.add(str(sentence))
+            added += 1
+
+        with self.lock:
+            if added:
+                self.save()
+
+        return added
@@ -5,24 +5,37 @@ from random import randint
 import time
 import json
 import sys
+import threading
 import schedule
 from twython import Twython
 
 from src.chain import Chain
 from src.wiki_scraper import WikiScraper
 from src.sentence import Sentence
+from src.tweet_pool import TweetPool
 import src.base as base
 
 # TODO: Read "Desired Subject" from file and set first_word in chain.
 
 class TwitterBot():
-    """Bot for posting on Twitter"""
+    """
+    Bot for posting on Twitter
+    The chain is kept in memory for every post. Corpus updates run in a
+    background thread, which then updates the model into a new chain and
+    swaps it in, so posts never wait for training.
+    Tweets are generated ahead of time into a TweetPool, refilled in the
+    background after model updates and when running low.
+    """
     def __init__(self, config_file):
         self.config_file = config_file
         self.config = None
         self._configure()
+        self.chain = None   # Chain with a built model, replaced whole when updated.
+        self.update_lock = threading.Lock()     # Held by the corpus update.
+        self.fill_lock = threading.Lock()       # Held while the tweet pool is filled.
+        self.pool = TweetPool("models/tweet_pool.json", self.config.get("tweet_pool_size", 20))
 
-        schedule.every().day.at(self.config["update_corpus_time"]).do(self._update_corpus)
+        schedule.every().day.at(self.config["update_corpus_time"]).do(self._in_background, self._update_corpus, self.update_lock)
         schedule.every().sunday.at(self.config["update_users_time"]).do(self._update_users)
         schedule.every().day.at(self.config["post_time"]).do(self._post)
 
@@ -30,6 +43,8 @@ class TwitterBot():
     def run(self):
         """Main loop"""
         base.prompt_print("Bot started.")
+        self.chain = self._build_chain()
+        self._in_background(self._fill_pool, self.fill_lock)
         while True:
             try:
                 schedule.run_pending()
@@ -45,24 +60,20 @@ class TwitterBot():
 
     def _post(self):
         """Post a generated sentence to Twitter."""
-        # Instantiate and generate the Markov chain.
         base.prompt_print("Posting to Twitter...")
-        completed = False
-        while not completed:
-            try:
-                chain = Chain("corpus")
-                chain.build_model()
-                completed = True
-            except:
-                raise
-
-
-        # Instantiate and generate a sentence.
-        completed = False
+        # The chain is read once, a swap during the post takes effect on the next one.
+        chain = self.chain
+        if chain is None:
+            chain = self.chain = self._build_chain()
+
+        # Take a pooled tweet of this model, or generate one if the pool is empty.
+        tweet = self.pool.pop(chain.fingerprint)
+        completed = tweet is not None
         while not completed:
             try:
                 sentence = Sentence(chain, randint(180, 260))
                 sentence.generate()
+                tweet = str(sentence)
                 completed = True
             except:
                 raise
@@ -78,23 +89,27 @@ class TwitterBot():
         while not completed:
             try:
                 twitter = Twython(APP_KEY, APP_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
-                twitter.update_status(status=str(sentence))
+                twitter.update_status(status=tweet)
                 completed = True
             except:
                 raise
 
         base.prompt_print("Succesfully posted to Twitter!")
 
+        if len(self.pool) < self.pool.size // 2:
+            self._in_background(self._fill_pool, self.fill_lock)
+
 
     def _update_corpus(self, all_pages=False):
         """Update Minervawiki-corpus"""
-        ws = WikiScraper()
+        ws = WikiScraper(corpus_path=self.config.get("corpus_path", "corpus"))
+        changes = None
         if all_pages:
             completed = False
             while not completed:
                 try:
                     base.prompt_print("Updating corpus from all pages...")
-                    ws.update_all_pages()
+                    changes = ws.update_all_pages()
                     completed = True
                 except:
                     raise
@@ -103,16 +118,60 @@ class TwitterBot():
             while not completed:
                 try:
                     base.prompt_print("Updating corpus from latest edits...")
-                    ws.update_recent_changes()
+                    changes = ws.update_recent_changes()
                     completed = True
                 except:
                     raise
 
         base.prompt_print("Finished updating corpus!")
 
+        # Apply the changed pages to a new chain, and swap it in once its model is ready.
+        if self.chain is None or any(changes.values()):
+            self.chain = self._build_chain(changes)
+            base.prompt_print("Updated model swapped in.")
+
+        # Waits for a refill started before the swap, then refills from the new chain.
+        with self.fill_lock:
+            self._fill_pool()
+
+    def _fill_pool(self):
+        """Fill the tweet pool from the current chain, replacing tweets of an older model."""
+        added = self.pool.fill(self.chain)
+        base.prompt_print("Added " + str(added) + " tweets to the pool.")
+
+    def _build_chain(self, changes=None):
+        """
+        Return new Chain with a model updated with changes, or loaded
+        or built from the corpus if it can't be updated.
+        """
+        chain = Chain(self.config.get("corpus_path", "corpus"), pruning=self.config.get("pruning"))
+        if changes is None or not chain.update_model(changes):
+            chain.build_model()
+
+        return chain
+
+    def _in_background(self, job, lock):
+        """
+        Run a job in a background thread holding lock, unless an earlier
+        job holding it is still running.
+        """
+        if not lock.acquire(blocking=False):
+            base.prompt_print("Skipping " + job.__name__ + ", an earlier one is still running.")
+            return
+
+        def run_job():
+            try:
+                job()
+            except BaseException as exception:
+                base.prompt_print("Error in twitter_bot." + job.__name__ + ": " + str(exception))
+            finally:
+                lock.release()
+
+        threading.Thread(target=run_job, daemon=True).start()
+
     def _update_users(self):
         """Update Minervawiki users"""
-        ws = WikiScraper()
+        ws = WikiScraper(corpus_path=self.config.get("corpus_path", "corpus"))
         completed = False
         while not completed:
             try:
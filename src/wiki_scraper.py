@@ -4,153 +4,519 @@
 import sys
 import json
 import os
+import hashlib
 import re
 import time
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from html.parser import HTMLParser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import progressbar
 
 import src.base as base
+from src.corpus_store import CorpusStore, is_corpus_store
+
+# Wikitext markup, see wikitext_to_text.
+WIKI_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+WIKI_REFERENCE = re.compile(r"<ref[^>]*/>|<ref[^>]*>.*?</ref>", re.DOTALL | re.IGNORECASE)
+WIKI_TEMPLATE = re.compile(r"\{\{[^{}]*\}\}")
+WIKI_TABLE = re.compile(r"\{\|.*?\|\}", re.DOTALL)
+WIKI_MEDIA_LINK = re.compile(r"\[\[(?:fil|file|bild|image|media|kategori|category):[^\[\]]*"
+                             r"(?:\[\[[^\[\]]*\]\][^\[\]]*)*\]\]", re.IGNORECASE)
+WIKI_LINK = re.compile(r"\[\[(?:[^|\[\]]*\|)?([^\[\]]*)\]\]")
+WIKI_EXTERNAL_LINK = re.compile(r"\[(?:https?:)?//[^\s\]]*\s*([^\]]*)\]")
+WIKI_EMPHASIS = re.compile(r"'{2,}")
+WEB_LINK = re.compile(r"http\S+")
+SPACES = re.compile(r"[^\S\n]{2,}")
+REGEX_SPECIAL = frozenset(".^$*+?{}[]\\|()")
+# Lines of headings, lists, tables and magic words, which aren't paragraphs.
+WIKI_NON_PARAGRAPH = ('=', '*', '#', ':', ';', '|', '!', '{', '}', '__')
+
+
+def wikitext_to_text(wikitext):
+    """
+    Return the paragraphs of a page's wikitext as plain text, one per line.
+    Templates, tables, references, files and categories are removed,
+    and links are replaced by their label.
+    """
+    text = WIKI_COMMENT.sub('', wikitext)
+    text = WIKI_REFERENCE.sub('', text)
+
+    # Templates nest, remove them from the innermost out.
+    count = 1
+    while count:
+        text, count = WIKI_TEMPLATE.subn('', text)
+
+    text = WIKI_TABLE.sub('', text)
+    text = WIKI_MEDIA_LINK.sub('', text)
+    text = WIKI_LINK.sub(r'\1', text)
+    text = WIKI_EXTERNAL_LINK.sub(r'\1', text)
+    text = WIKI_EMPHASIS.sub('', text)
+
+    paragraphs = [line.strip() for line in text.split('\n')]
+    return '\n'.join(line for line in paragraphs if line and not line.startswith(WIKI_NON_PARAGRAPH))
+
+
+def blacklist_pattern(words):
+    """
+    Return one compiled pattern matching any of the blacklisted words,
+    or None if there are none. Words are patterns themselves. Plain words
+    are merged into a trie, so the pattern branches a character at a time
+    instead of trying every word at every position. The longest plain
+    word is matched.
+    """
+    trie = dict()
+    patterns = list()
+    for word in words:
+        if not word:
+            continue
+        if any(char in REGEX_SPECIAL for char in word):
+            patterns.append('(?:%s)' % word)
+            continue
+
+        node = trie
+        for char in word:
+            node = node.setdefault(char, dict())
+        node[''] = None
+
+    def branch(node):
+        """Return pattern of the words below a trie node."""
+        alternatives = [re.escape(char) + branch(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+
+        pattern = '(?:%s)' % '|'.join(alternatives) if len(alternatives) > 1 else alternatives[0]
+        # A word ends here, longer words are optional.
+        if '' in node:
+            pattern = '(?:%s)?' % pattern
+
+        return pattern
+
+    if trie:
+        patterns.insert(0, '(?:%s)' % branch(trie))
+
+    return re.compile('|'.join(patterns)) if patterns else None
+
+
+class TextExtractor(HTMLParser):
+    """
+    Collects the text of HTML fed to it, without tags, comments and
+    the contents of script and style elements. Entities are decoded.
+    """
+    skipped_tags = ('script', 'style')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = list()
+        self.skipping = 0   # Depth of skipped elements the parser is in.
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped_tags:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped_tags and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    @classmethod
+    def extract(cls, html):
+        """Return the text of an HTML string."""
+        parser = cls()
+        parser.feed(html)
+        parser.close()
+
+        return ''.join(parser.parts)
+
+
+class RateLimiter():
+    """Spaces out calls to wait() from any number of threads to at most rate per second."""
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
 
 
 class WikiScraper():
-    """Web Scraper for minervawikin.nu"""
-    def __init__(self):
-        self.base_url = "https://minervawikin.nu"
+    """
+    Web Scraper for minervawikin.nu
+    Pages are fetched through the MediaWiki API of base_url, batch_size
+    pages per request. Batches are fetched by workers threads sharing one
+    keep-alive session, at most rate_limit requests per second in total.
+    Transient failures are retried with backoff.
+    Pages whose listed revision is already in the corpus aren't fetched.
+    The corpus is a folder of text files, or a CorpusStore if corpus_path
+    ends with .db.
+    """
+    def __init__(self, base_url="https://minervawikin.nu", workers=4, rate_limit=5, corpus_path="corpus"):
+        self.base_url = base_url
+        self.batch_size = 50    # Most titles the API accepts per query.
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.timeout = 30
+        self.session = self.create_session()
         self.pages = list()
+        self.revisions = dict()  # Latest revision id of listed pages.
+        self.failed = set()     # Titles of pages the last build_corpus couldn't fetch.
+        self.index_path = "config/page_index.json"
+        self.index = self.load_index()  # Revision and content of every corpus page.
+        self.index_changed = False      # Whether the index differs from the saved one.
+        self.cursor_path = "config/recent_changes.json"    # Last change applied to the corpus.
         self.blacklist_file = "config/corpus_blacklist.txt"
-        self.blacklist = list()
+        self.blacklist = set()
         self.corpus_folder = "corpus"
-        self.corpus_path = "corpus"
+        self.corpus_path = corpus_path
+        self.corpus_store = CorpusStore(corpus_path, create=True) if is_corpus_store(corpus_path) else None
         self.word_blacklist = list()
         if os.path.isfile("config/word_blacklist.txt"):
             with open("config/word_blacklist.txt", encoding='utf8') as file:
                 self.word_blacklist = file.read().split("\n")
 
+        self.word_blacklist_pattern = blacklist_pattern(self.word_blacklist)
+
         if os.path.isfile(self.blacklist_file):
             with open(self.blacklist_file, encoding='utf8') as file:
-                self.blacklist = file.read().split("\n")
+                self.blacklist = set(file.read().split("\n"))
 
 
     def build_corpus(self):
-        """Build corpus files"""
+        """
+        Build corpus files.
+        Return change set of corpus file names, a dict of 'added', 'replaced'
+        and 'removed' lists, for Chain.update_model.
+        """
         # TODO: Find out why some words have  spaces in them (start of sentence)
-        i = 0
+        changes = {"added": [], "replaced": [], "removed": []}
+        self.failed = set()
+
+        if self.corpus_store is None and not os.path.exists(self.corpus_path):
+            os.makedirs(self.corpus_path)
 
         p_bar = progressbar.ProgressBar(maxval=len(self.pages), term_width=50, \
         widgets=[progressbar.Bar('=', '[', ']'), ' ', progressbar.Percentage()])
         p_bar.start()
-        for page_title in self.pages:
-            url = self.base_url + "/wiki/" + page_title
-            res = self.get_url(url)
-            p_bar.update(i+1)
 
-            regex = r"<p>(.*?)<\/p>"
+        # Batches are fetched concurrently, and written in order as they arrive.
+        pages = [page_title for page_title in self.pages if self.is_stale(page_title)]
+        batches = [pages[i:i + self.batch_size] for i in range(0, len(pages), self.batch_size)]
+        i = len(self.pages) - len(pages)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch, contents in zip(batches, executor.map(self.fetch_batch, batches)):
+                for page_title in batch:
+                    i += 1
+                    p_bar.update(i)
+                    if page_title in contents:
+                        revision, content = contents[page_title]
+                        self.write_page(page_title, revision, content, changes)
 
-            content = re.findall(regex, res.text, re.DOTALL)
-            content_text = ""
-            if content:
-                for j in range(len(content)):
-                    content_text += content[j]
+        p_bar.finish()
+        # The run's writes are committed together, before the index records them.
+        if self.corpus_store is not None:
+            self.corpus_store.commit()
+        self.save_index()
+
+        return changes
+
+    def is_stale(self, page_title):
+        """Return whether a listed page has a newer revision than its corpus file, or no file."""
+        entry = self.index.get(page_title)
+        if entry is None or entry["revid"] != self.revisions.get(page_title):
+            return True
+
+        return not self.has_corpus_file(self.file_name(page_title))
+
+    def fetch_batch(self, page_titles):
+        """
+        Return dict of the latest revision and cleaned text of wiki pages by title,
+        fetched in one API query. Revisions are dicts of 'revid' and 'timestamp'.
+        Pages that are missing or couldn't be fetched are left out, the titles
+        that couldn't be fetched are added to self.failed.
+        """
+        params = {
+            "action": "query",
+            "prop": "revisions",
+            "rvprop": "ids|timestamp|content",
+            "rvslots": "main",
+            "format": "json",
+            "formatversion": "2",
+            "titles": "|".join(page_titles)
+        }
+        titles = dict()     # Requested title of every normalized title.
+        contents = dict()
+        missing = set()
+
+        # Large pages can push content of the rest into continued queries.
+        while True:
+            res = self.get_url(self.base_url + "/api.php", params)
+            if res is None:
+                break
 
-                content = ''.join(content_text)
+            json_data = res.json()
+            query = json_data.get("query", {})
+            for normalized in query.get("normalized", []):
+                titles[normalized["to"]] = normalized["from"]
+
+            for page in query.get("pages", []):
+                title = titles.get(page["title"], page["title"])
+                if page.get("missing") or page.get("invalid"):
+                    missing.add(title)
+                revisions = page.get("revisions")
+                if revisions:
+                    revision = revisions[0]
+                    content = wikitext_to_text(revision["slots"]["main"]["content"])
+                    contents[title] = (revision, self.clean_content(content))
+
+            if "continue" not in json_data:
+                break
+            params.update(json_data["continue"])
+
+        self.failed.update(title for title in page_titles if title not in contents and title not in missing)
+
+        return contents
+
+    def clean_content(self, content):
+        """Return page text without HTML tags, web links and blacklisted words."""
+        # Remove HTML tags, and decode "&" tokens
+        content = TextExtractor.extract(content)
+
+        # Remove web links
+        content = WEB_LINK.sub('', content)
+
+        # Remove multiple whitespace?
+        content = SPACES.sub(' ', content).strip()
+
+        # Remove blacklisted words
+        if self.word_blacklist_pattern is not None:
+            content = self.word_blacklist_pattern.sub('', content)
+
+        return content
+
+    def write_page(self, page_title, revision, content, changes):
+        """
+        Write content of a page revision to its corpus file, and record it in changes if it changed.
+        The revision and a hash of the content are kept in the page index.
+        """
+        file_name = self.file_name(page_title)
+        entry = self.index.get(page_title)
+        self.index[page_title] = {
+            "revid": revision["revid"],
+            "timestamp": revision["timestamp"],
+            "sha1": hashlib.sha1(content.encode('utf8')).hexdigest()
+        }
+        if self.index[page_title] != entry:
+            self.index_changed = True
+
+        # Leave unchanged pages alone, so they aren't counted as changes.
+        # New revisions can leave the text unchanged, after cleaning.
+        if self.has_corpus_file(file_name):
+            if entry is not None:
+                unchanged = entry["sha1"] == self.index[page_title]["sha1"]
             else:
-                content = ""
-
-            # Remove HTML tags
-            # clean = re.compile('<.*?>')
-            content = re.sub('<.*?>', '', content)
-            content = re.sub("</p", '', content)
+                unchanged = self.read_corpus_file(file_name) == content
+            if unchanged:
+                return
+            changes["replaced"].append(file_name)
+        else:
+            changes["added"].append(file_name)
+
+        if self.corpus_store is not None:
+            self.corpus_store.write(file_name, page_title, revision, content)
+        else:
+            with open(self.corpus_path + "/" + file_name, "w") as file:
+                file.write(content)
 
-            # Remove web links
-            content = re.sub(r'http\S+', '', content)
+    def has_corpus_file(self, file_name):
+        """Return whether the corpus has a file, in its folder or store."""
+        if self.corpus_store is not None:
+            return file_name in self.corpus_store
 
-            # Remove multiple whitespace?
-            content = re.sub(r'\s{2,}', ' ', content).strip()
+        return os.path.isfile(os.path.join(self.corpus_path, file_name))
 
-            # Remove blacklisted words
-            for word in self.word_blacklist:
-                content = re.sub(word, '', content)
+    def read_corpus_file(self, file_name):
+        """Return text of a corpus file, in its folder or store."""
+        if self.corpus_store is not None:
+            return self.corpus_store.read(file_name)
 
-            # Fix "&" tokens
-            content = re.sub('&amp;', '&', content)
+        with open(os.path.join(self.corpus_path, file_name)) as file:
+            return file.read()
 
-            if not os.path.exists(self.corpus_path):
-                os.makedirs(self.corpus_path)
+    @staticmethod
+    def file_name(page_title):
+        """Return corpus file name of a page, its title with slashes replaced."""
+        return re.sub(r"[\/]", '_', page_title) + ".txt"
 
-            # Strip slashes from page_title and set as file_name.
-            # Then build file_path.
-            file_name = re.sub(r"[\/]", '_', page_title)
-            file_path = self.corpus_path + "/" + file_name + ".txt"
+    def load_index(self):
+        """Return saved dict of the revision id, timestamp and content hash of every corpus page."""
+        if not os.path.isfile(self.index_path):
+            return dict()
 
-            with open(file_path, "w") as file:
-                file.write(content)
+        with open(self.index_path, encoding='utf8') as file:
+            return json.load(file)
 
-            if i % 5 == 0:
-                time.sleep(0.8)
-            i += 1
+    def save_index(self):
+        """Save the page index with base.write_json if it changed. Unchanged pages cost no writes."""
+        if not self.index_changed:
+            return
 
-        p_bar.finish()
+        base.write_json(self.index_path, self.index)
+        self.index_changed = False
 
     def update_all_pages(self):
-        """Get list of pages available on the wiki"""
+        """
+        Get list of pages available on the wiki and rebuild the corpus from them.
+        Corpus files of pages no longer on the wiki are removed.
+        If the listing can't be completed, as a query failed or the API
+        answered with an error, nothing is changed.
+        Return change set of corpus file names.
+        """
         self.pages = list()
+        self.revisions = dict()
         end_of_categories = False
-        continue_param = ""
+        params = {
+            "action": "query",
+            "generator": "allpages",
+            "gaplimit": "500",
+            "prop": "info",
+            "format": "json",
+            "formatversion": "2"
+        }
 
         while not end_of_categories:
-            url = self.base_url
-            url += "/api.php?action=query&list=allpages&aplimit=500&format=json"
-            url += continue_param
-            res = self.get_url(url)
-            # TODO: Check for None result.
-
-            json_data = json.loads(res.text)
-            for page in json_data["query"]["allpages"]:
+            # A partial listing would remove every page left out of it.
+            json_data = self.get_api(params)
+            if json_data is None:
+                base.prompt_print("Couldn't list the wiki's pages, corpus left unchanged.")
+                return {"added": [], "replaced": [], "removed": []}
+
+            for page in json_data.get("query", {}).get("pages", []):
                 # Skip blacklisted pages
                 if page["title"] not in self.blacklist:
                     self.pages.append(page["title"])
+                    self.revisions[page["title"]] = page["lastrevid"]
 
             if "continue" in json_data:
-                continue_param = "&apfrom=" + json_data["continue"]["apcontinue"]
+                params.update(json_data["continue"])
             else:
                 end_of_categories = True
 
-        self.build_corpus()
+        changes = self.build_corpus()
+
+        page_files = set(self.file_name(page_title) for page_title in self.pages)
+        if self.corpus_store is not None:
+            for file_name in self.corpus_store.documents():
+                if file_name not in page_files:
+                    self.corpus_store.remove(file_name)
+                    changes["removed"].append(file_name)
+            self.corpus_store.commit()
+        elif os.path.isdir(self.corpus_path):
+            for file_name in os.listdir(self.corpus_path):
+                if file_name not in page_files:
+                    os.remove(os.path.join(self.corpus_path, file_name))
+                    changes["removed"].append(file_name)
+
+        listed = set(self.pages)
+        index = {page_title: entry for page_title, entry in self.index.items() if page_title in listed}
+        if len(index) != len(self.index):
+            self.index = index
+            self.index_changed = True
+        self.save_index()
+
+        return changes
 
     def update_recent_changes(self):
-        """Update pages that have been edited/created yesterday"""
-        self.pages = list()
+        """
+        Update pages that have been edited/created since the last update,
+        or since yesterday on the first update.
+        Changes are listed oldest first from a saved cursor, the timestamp
+        and id of the last change applied, so missed days are caught up.
+        The cursor stops before the first change of a page that couldn't be
+        fetched, so the page is fetched again on the next update.
+        Return change set of corpus file names.
+        """
+        cursor = self.load_cursor()
+        if cursor is None:
+            yesterday = datetime.now(timezone.utc) - timedelta(1)
+            cursor = {"timestamp": yesterday.strftime('%Y-%m-%dT%H:%M:%SZ'), "rcid": 0}
+
+        self.revisions = dict()
+        titles = dict()     # Changed titles in order, without duplicates.
         end_of_updates = False
-        continue_param = ""
+        params = {
+            "action": "query",
+            "list": "recentchanges",
+            "rcprop": "title|timestamp|ids",
+            "rcdir": "newer",
+            "rcstart": cursor["timestamp"],
+            "rclimit": "max",
+            "format": "json",
+            "formatversion": "2"
+        }
+        listed = list()     # Cursor and title of every change, oldest first.
 
         while not end_of_updates:
-            url = self.base_url
-            url += "/api.php?action=query&list=recentchanges&rcprop=title"
-            url += "|timestamp&rclimit=50&format=json"
-            url += continue_param
-            res = self.get_url(url)
-            # TODO: Check for None result.
-            json_data = res.json()
-            post_day = None
-            yesterday = datetime.today() - timedelta(1)
-            yesterday = yesterday.day
+            # Changes listed before a failed query are still applied.
+            json_data = self.get_api(params)
+            if json_data is None:
+                break
+
+            for change in json_data["query"]["recentchanges"]:
+                # rcstart is inclusive, skip changes at the cursor's timestamp that were already applied.
+                if change["timestamp"] == cursor["timestamp"] and change["rcid"] <= cursor["rcid"]:
+                    continue
+                listed.append(({"timestamp": change["timestamp"], "rcid": change["rcid"]}, change["title"]))
 
-            for page in json_data["query"]["recentchanges"]:
                 # Skip blacklisted pages
-                if page["title"] not in self.blacklist:
-                    self.pages.append(page["title"])
+                if change["title"] in self.blacklist:
+                    continue
 
-                post_day = datetime.strptime(page["timestamp"][:10], '%Y-%m-%d').day
-                if post_day == yesterday and page["title"] not in self.pages:
-                    self.pages.append(page["title"])
+                # Changes are oldest first, the last revision of a page is its latest.
+                titles[change["title"]] = None
+                self.revisions[change["title"]] = change["revid"]
 
-            if post_day == yesterday:
-                continue_param = "&rcstart=" + json_data["continue"]["rccontinue"][:14]
+            if "continue" in json_data:
+                params.update(json_data["continue"])
             else:
                 end_of_updates = True
 
-        self.build_corpus()
+        self.pages = list(titles)
+        changes = self.build_corpus()
+
+        last_change = cursor
+        for change, title in listed:
+            if title in self.failed:
+                break
+            last_change = change
+        self.save_cursor(last_change)
+
+        return changes
+
+    def load_cursor(self):
+        """Return the saved dict of 'timestamp' and 'rcid' of the last change applied, or None."""
+        if not os.path.isfile(self.cursor_path):
+            return None
+
+        with open(self.cursor_path, encoding='utf8') as file:
+            return json.load(file)
+
+    def save_cursor(self, cursor):
+        """Save the last change applied, for the next update_recent_changes."""
+        base.write_json(self.cursor_path, cursor)
 
     def update_users(self):
         """Update list of users"""
@@ -176,13 +542,47 @@ class WikiScraper():
                 file.write("%s\n" % user)
 
 
-    @staticmethod
-    def get_url(url):
-        """General GET request"""
+    def create_session(self):
+        """Return Session reusing connections for all workers, retrying transient failures."""
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=retry)
+
+        session = requests.Session()
+        session.headers['User-Agent'] = 'knutte-bot'
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def get_api(self, params):
+        """
+        Return the JSON response of an API query, or None if the query
+        failed, the response isn't JSON or the API answered with an error.
+        """
+        res = self.get_url(self.base_url + "/api.php", params)
+        if res is None:
+            return None
+
+        try:
+            json_data = res.json()
+        except ValueError:
+            base.prompt_print("API response is not JSON.")
+            return None
+
+        # Errors like maxlag are answered with status 200.
+        if "error" in json_data:
+            base.prompt_print("API error: " + str(json_data["error"].get("code")))
+            return None
+
+        return json_data
+
+    def get_url(self, url, params=None):
+        """General GET request, waiting for the rate limit"""
         res = None
 
         try:
-            res = requests.get(url, headers={'User-Agent': 'knutte-bot'})
+            self.rate_limiter.wait()
+            res = self.session.get(url, params=params, timeout=self.timeout)
 
         except KeyboardInterrupt:
             base.prompt_print("The program was manually interrupted, bye!")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+""" Tests of saved model updates against full rebuilds """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import src.model as markov_model
+from src.chain import Chain
+
+CORPUS = {
+    "Sappa.txt": "Sappa är en förening på Campus. Sappa grundades av studenter.\n"
+                 "Föreningen håller en skiva varje år.",
+    "Knutte.txt": "Knutte är en maskot. Knutte går på skivan varje år.",
+    "Campus.txt": "Campus har en förening och en maskot.",
+    "Skiva.txt": "Skivan hålls på Campus. Alla studenter går på skivan.",
+    "Studenter.txt": "Studenter läser på Campus. Många studenter går med i en förening.",
+    "Styrelse.txt": "Styrelsen leder föreningen. Styrelsen väljs varje år.",
+    "Mat.txt": "Föreningen lagar mat till skivan. Maten är god.",
+    "Musik.txt": "Det spelas musik på skivan. Knutte dansar till musiken.",
+}
+
+
+def saved_counts(path):
+    """Return dict of successor counts by word of the model saved at path, by key of words."""
+    vocabulary = markov_model.load_vocabulary(path)
+    counts = dict()
+    for key, (steps, cumulative) in markov_model.load_model(path).items():
+        words = tuple(vocabulary[i] for i in key)
+        counts[words] = {vocabulary[step]: count - before
+                         for step, count, before in zip(steps, cumulative, [0] + list(cumulative))}
+
+    return counts
+
+
+class UpdateSavedModelTest(unittest.TestCase):
+    """Tests of Chain.update_model and model.update_saved_model."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        os.mkdir("corpus")
+        for name, text in CORPUS.items():
+            self.write("corpus/" + name, text)
+
+        Chain("corpus").build_model()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    @staticmethod
+    def write(path, text):
+        with open(path, "w", encoding='utf8') as file:
+            file.write(text)
+
+    def assert_rebuilt(self, changes):
+        """Update the saved model, and assert it counts the same as one built from the corpus."""
+        self.assertTrue(Chain("corpus").update_model(changes, load=False))
+        updated = saved_counts("models/markov")
+
+        shutil.rmtree("models")
+        Chain("corpus").build_model()
+        self.assertEqual(updated, saved_counts("models/markov"))
+
+    def test_changes_count_like_a_rebuild(self):
+        with open("corpus/Sappa.txt", "a", encoding='utf8') as file:
+            file.write("\nSappa har en maskot som heter Knutte.")
+        self.write("corpus/Knutte.txt", "Knutte är en glad maskot på Campus.")
+        os.remove("corpus/Campus.txt")
+        self.write("corpus/Fest.txt", "Festen hålls på Campus varje år.")
+
+        self.assert_rebuilt({"added": ["Fest.txt"], "replaced": ["Sappa.txt", "Knutte.txt"],
+                             "removed": ["Campus.txt"]})
+
+    def test_replaced_documents_are_compacted(self):
+        store = markov_model.DocumentStore("models/documents")
+        for repeats in range(10, 60, 10):
+            self.write("corpus/Knutte.txt", "\n".join(["Knutte är en maskot på Campus."] * repeats))
+            self.assertTrue(Chain("corpus").update_model(None, load=False))
+
+            self.assertTrue(store.load())
+            live = sum(length for _, _, length in store.index.values())
+            self.assertLessEqual(os.path.getsize(store.data_path), 2 * live)
+
+        self.write("corpus/Knutte.txt", "Knutte går på skivan.")
+        self.assert_rebuilt(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
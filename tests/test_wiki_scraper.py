@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+""" Tests of WikiScraper against the stand-in wiki api """
+
+import os
+import tempfile
+import unittest
+
+from src.wiki_scraper import WikiScraper, wikitext_to_text
+from tests.wiki_api import WikiApi, PAGES
+
+
+class WikitextToTextTest(unittest.TestCase):
+    """Tests of wikitext_to_text."""
+
+    def test_links_are_replaced_by_their_label(self):
+        self.assertEqual(wikitext_to_text("En [[Förening|förening]] på [[Campus]]."),
+                         "En förening på Campus.")
+
+    def test_external_links_are_replaced_by_their_label(self):
+        self.assertEqual(wikitext_to_text("En [http://example.com maskot] och [//example.com]."),
+                         "En maskot och .")
+
+    def test_nested_templates_are_removed(self):
+        self.assertEqual(wikitext_to_text("Före {{Infobox|namn={{när|1990}}}}efter."), "Före efter.")
+
+    def test_references_and_comments_are_removed(self):
+        self.assertEqual(wikitext_to_text("Text.<ref name=\"a\">Källa</ref><ref name=\"b\" /><!-- dold\nrad -->"),
+                         "Text.")
+
+    def test_files_and_categories_are_removed(self):
+        wikitext = "[[Fil:Bild.jpg|miniatyr|Text med [[länk]]]]Text.\n[[Kategori:Föreningar]]"
+        self.assertEqual(wikitext_to_text(wikitext), "Text.")
+
+    def test_emphasis_is_removed(self):
+        self.assertEqual(wikitext_to_text("'''Sappa''' är ''bra''."), "Sappa är bra.")
+
+    def test_only_paragraphs_are_kept(self):
+        wikitext = ("== Rubrik ==\nFörsta stycket.\n\n* lista\n# numrerad\n: indrag\n"
+                    "{| class=\"wikitable\"\n| cell\n|}\n__NOTOC__\nAndra stycket.")
+        self.assertEqual(wikitext_to_text(wikitext), "Första stycket.\nAndra stycket.")
+
+
+class ScraperTestCase(unittest.TestCase):
+    """
+    Base of tests against the stand-in wiki api. Every test runs in an empty
+    working directory, so no config or corpus of a checkout is read.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.api = WikiApi()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.api.stop()
+
+    def setUp(self):
+        self.api.queries.clear()
+        self.api.listing_error = None
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+
+class FetchBatchTest(ScraperTestCase):
+    """Tests of WikiScraper.fetch_batch."""
+
+    def setUp(self):
+        super().setUp()
+        self.scraper = WikiScraper(base_url=self.api.base_url, workers=1, rate_limit=1000)
+
+    def tearDown(self):
+        self.scraper.session.close()
+        super().tearDown()
+
+    def test_contents_are_cleaned_text(self):
+        contents = self.scraper.fetch_batch(["Sappa", "Knutte"])
+        revision, content = contents["Sappa"]
+        self.assertEqual(revision["revid"], 100)
+        self.assertEqual(revision["timestamp"], "2020-01-01T00:00:00Z")
+        self.assertEqual(content, "Sappa är en förening på Campus.\nSappa grundades av studenter.")
+        self.assertEqual(contents["Knutte"][1], "Knutte är en maskot.")
+
+    def test_normalized_titles_are_kept_as_requested(self):
+        contents = self.scraper.fetch_batch(["sappa_skiva", "Knutte"])
+        self.assertEqual(set(contents), {"sappa_skiva", "Knutte"})
+        self.assertEqual(contents["sappa_skiva"][1], "Skivan hålls varje år.")
+
+    def test_missing_pages_are_left_out(self):
+        contents = self.scraper.fetch_batch(["Sappa", "Finns inte"])
+        self.assertEqual(set(contents), {"Sappa"})
+        self.assertEqual(self.scraper.failed, set())
+
+    def test_continued_contents_are_fetched(self):
+        titles = list(PAGES)
+        contents = self.scraper.fetch_batch(titles)
+        self.assertEqual(set(contents), set(titles))
+        self.assertEqual(len(self.api.queries), 2)
+        self.assertEqual(self.api.queries[1]["rvcontinue"], "2")
+
+    def test_pages_that_fail_are_recorded(self):
+        contents = self.scraper.fetch_batch(["Sappa", "Trasig"])
+        self.assertEqual(contents, {})
+        self.assertEqual(self.scraper.failed, {"Sappa", "Trasig"})
+
+
+class UpdateAllPagesTest(ScraperTestCase):
+    """Tests of WikiScraper.update_all_pages."""
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir("corpus")
+        with open("corpus/Gammal sida.txt", "w") as file:
+            file.write("Text.")
+
+        self.scraper = WikiScraper(base_url=self.api.base_url, workers=1, rate_limit=1000)
+        self.scraper.index = {"Gammal sida": {"revid": 1}}
+
+    def tearDown(self):
+        self.scraper.session.close()
+        super().tearDown()
+
+    def assert_unchanged(self, changes):
+        self.assertEqual(changes, {"added": [], "replaced": [], "removed": []})
+        self.assertEqual(os.listdir(self.scraper.corpus_path), ["Gammal sida.txt"])
+        self.assertEqual(self.scraper.index, {"Gammal sida": {"revid": 1}})
+        self.assertFalse(os.path.isfile(self.scraper.index_path))
+
+    def test_error_response_changes_nothing(self):
+        self.api.listing_error = 0
+        self.assert_unchanged(self.scraper.update_all_pages())
+        self.assertEqual(len(self.api.queries), 1)
+
+    def test_error_in_continued_listing_changes_nothing(self):
+        self.api.listing_error = 2
+        self.assert_unchanged(self.scraper.update_all_pages())
+        self.assertEqual(len(self.api.queries), 2)
+
+
+class UpdateRecentChangesTest(ScraperTestCase):
+    """Tests of WikiScraper.update_recent_changes."""
+
+    def setUp(self):
+        super().setUp()
+        self.cursor = {"timestamp": "2020-01-01T00:00:00Z", "rcid": 0}
+        self.scraper = WikiScraper(base_url=self.api.base_url, workers=1, rate_limit=1000)
+        self.scraper.save_cursor(self.cursor)
+
+    def tearDown(self):
+        self.scraper.session.close()
+        super().tearDown()
+
+    def test_all_changes_are_applied(self):
+        changes = self.scraper.update_recent_changes()
+        self.assertEqual(changes["added"], [WikiScraper.file_name(title) for title in PAGES])
+        self.assertEqual(self.scraper.load_cursor(), {"timestamp": "2020-01-04T00:00:00Z", "rcid": 1003})
+
+    def test_error_response_changes_nothing(self):
+        self.api.listing_error = 0
+        changes = self.scraper.update_recent_changes()
+        self.assertEqual(changes, {"added": [], "replaced": [], "removed": []})
+        self.assertEqual(self.scraper.load_cursor(), self.cursor)
+
+    def test_changes_before_an_error_are_applied(self):
+        self.api.listing_error = 2
+        changes = self.scraper.update_recent_changes()
+        self.assertEqual(changes["added"], ["Sappa.txt", "Sappa skiva.txt"])
+        self.assertEqual(self.scraper.load_cursor(), {"timestamp": "2020-01-02T00:00:00Z", "rcid": 1001})
+
+
+if __name__ == '__main__':
+    unittest.main()
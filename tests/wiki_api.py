@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+""" Stand-in for the wiki's api.php, serving canned pages """
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Wikitext of the canned pages by title.
+PAGES = {
+    "Sappa": "'''Sappa''' är en [[Förening|förening]] på [[Campus]].<ref>Källa</ref>\n"
+             "== Historia ==\n"
+             "Sappa grundades {{när|1990}} av studenter.",
+    "Sappa skiva": "Skivan hålls varje år.",
+    "Knutte": "Knutte är en [http://example.com maskot].",
+    "Stor sida": "En sida med mycket text.",
+}
+FAILING = {"Trasig"}    # Titles whose queries are answered with status 404.
+
+
+class WikiApi(ThreadingHTTPServer):
+    """
+    HTTP server answering revision queries of WikiScraper.fetch_batch like
+    api.php with formatversion=2. Titles are normalized like the wiki does,
+    titles not in pages are missing, and at most contents_per_response
+    pages get their content in one response, the rest are continued.
+    Listings of all pages, and of recent changes with one change of every
+    page, give pages_per_listing pages per response, and the response at
+    listing_error, a continue position, is an error.
+    Every query is kept in queries.
+    """
+    daemon_threads = True
+
+    def __init__(self, pages=PAGES, failing=FAILING, contents_per_response=2):
+        super().__init__(('127.0.0.1', 0), WikiApiHandler)
+        self.pages = pages
+        self.failing = failing
+        self.contents_per_response = contents_per_response
+        self.pages_per_listing = 2
+        self.listing_error = None
+        self.queries = list()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self):
+        """Return base url to give WikiScraper."""
+        return "http://127.0.0.1:%d" % self.server_port
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+    @staticmethod
+    def normalize(title):
+        """Return title like the wiki normalizes it, with spaces and a capital first letter."""
+        title = title.replace('_', ' ').strip()
+        return title[:1].upper() + title[1:]
+
+    def list_pages(self, params):
+        """Return the response dict of a listing of all pages."""
+        start = int(params.get("gapcontinue", 0))
+        if start == self.listing_error:
+            return {"error": {"code": "maxlag", "info": "Waiting for a database server."}}
+
+        titles = list(self.pages)[start:start + self.pages_per_listing]
+        pages = [{"pageid": start + index + 1, "ns": 0, "title": title, "lastrevid": 100 + start + index}
+                 for index, title in enumerate(titles)]
+        response = {"batchcomplete": True, "query": {"pages": pages}}
+        if start + self.pages_per_listing < len(self.pages):
+            response["continue"] = {"gapcontinue": str(start + self.pages_per_listing), "continue": "gapcontinue||"}
+
+        return response
+
+    def list_recent_changes(self, params):
+        """Return the response dict of a listing of recent changes, oldest first."""
+        start = int(params.get("rccontinue", 0))
+        if start == self.listing_error:
+            return {"error": {"code": "maxlag", "info": "Waiting for a database server."}}
+
+        titles = list(self.pages)[start:start + self.pages_per_listing]
+        changes = [{"type": "edit", "ns": 0, "title": title, "rcid": 1000 + start + index,
+                    "revid": 100 + start + index, "timestamp": "2020-01-0%dT00:00:00Z" % (start + index + 1)}
+                   for index, title in enumerate(titles)]
+        response = {"batchcomplete": True, "query": {"recentchanges": changes}}
+        if start + self.pages_per_listing < len(self.pages):
+            response["continue"] = {"rccontinue": str(start + self.pages_per_listing), "continue": "-||"}
+
+        return response
+
+    def query(self, params):
+        """Return the response dict of a revision query."""
+        titles = params["titles"].split('|')
+        start = int(params.get("rvcontinue", 0))
+        normalized = list()
+        pages = list()
+        for index, title in enumerate(titles):
+            to = self.normalize(title)
+            if to != title:
+                normalized.append({"fromencoded": False, "from": title, "to": to})
+            if to not in self.pages:
+                pages.append({"ns": 0, "title": to, "missing": True})
+                continue
+
+            page = {"pageid": index + 1, "ns": 0, "title": to}
+            if start <= index < start + self.contents_per_response:
+                page["revisions"] = [{
+                    "revid": 100 + index,
+                    "parentid": 0,
+                    "timestamp": "2020-01-01T00:00:00Z",
+                    "slots": {"main": {"contentmodel": "wikitext", "contentformat": "text/x-wiki",
+                                       "content": self.pages[to]}}
+                }]
+            pages.append(page)
+
+        response = {"batchcomplete": True, "query": {"normalized": normalized, "pages": pages}}
+        if start + self.contents_per_response < len(titles):
+            del response["batchcomplete"]
+            response["continue"] = {"rvcontinue": str(start + self.contents_per_response),
+                                    "continue": "||"}
+
+        return response
+
+
+class WikiApiHandler(BaseHTTPRequestHandler):
+    """Request handler of WikiApi."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Answer a query."""
+        params = {name: values[-1] for name, values in parse_qs(urlparse(self.path).query).items()}
+        self.server.queries.append(params)
+        if any(title in self.server.failing for title in params.get("titles", "").split('|')):
+            self.send_json(404, {"error": {"code": "failing"}})
+            return
+
+        if params.get("generator") == "allpages":
+            self.send_json(200, self.server.list_pages(params))
+            return
+        if params.get("list") == "recentchanges":
+            self.send_json(200, self.server.list_recent_changes(params))
+            return
+
+        self.send_json(200, self.server.query(params))
+
+    def send_json(self, status, data):
+        """Send data as a JSON response."""
+        body = json.dumps(data, ensure_ascii=False).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log requests."""